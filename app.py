@@ -1,16 +1,45 @@
 import streamlit as st
 import pandas as pd
+import numpy as np
 import plotly.express as px
 import plotly.graph_objects as go
+import plotly.io as pio
 import requests
+from requests.adapters import HTTPAdapter
 import time
+import hashlib
+import threading
+import queue
+import contextvars
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from urllib.parse import quote
+from streamlit.runtime.scriptrunner import add_script_run_ctx, get_script_run_ctx
 from supabase import create_client, Client
+from postgrest.types import ReturnMethod
 import os
+import shutil
+from pathlib import Path
+from uuid import uuid4
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 from dotenv import load_dotenv
+from geocoding_utils import RateLimiter, address_key, open_cache, upload_frame, is_payload_too_large
+
+# Serialize figures with orjson, much faster than the stdlib encoder on long numeric arrays
+pio.json.config.default_engine = 'orjson'
 
 # Load environment variables
 load_dotenv()
 
+# Geocoding provider: "nominatim" (default) or "mapbox_batch"
+GEOCODER_BACKEND = os.getenv("GEOCODER_BACKEND", "nominatim")
+MAPBOX_ACCESS_TOKEN = os.getenv("MAPBOX_ACCESS_TOKEN")
+MAPBOX_BATCH_SIZE = 50  # Max queries per Mapbox batch request
+MAPBOX_MAX_WORKERS = 4  # Batch requests in flight at once
+MAPBOX_MAX_QPS = 10  # Mapbox allows 600 batch requests per minute
+NOMINATIM_MAX_WORKERS = 4  # Overlapping requests; the rate limiter still allows 1 per second
+
 # Page config
 st.set_page_config(
     page_title="Glenwood Group Teacher Analytics",
@@ -67,29 +96,61 @@ def init_supabase():
 
 supabase = init_supabase()
 
-# Helper functions for data conversion
-def to_bool(val):
-    """Convert value to boolean, handling various input formats."""
-    if pd.isna(val):
-        return None
-    if isinstance(val, bool):
-        return val
-    val_str = str(val).strip().lower()
-    return val_str in ['yes', 'y', 'true', '1']
-
-def to_int(val):
-    """Convert value to integer, handling various input formats."""
-    if pd.isna(val):
-        return None
-    try:
-        return int(float(val))
-    except (ValueError, TypeError):
-        val_str = str(val).strip()
-        if val_str.lower() in ['yes', 'y', 'true']:
-            return 100
-        if val_str.lower() in ['no', 'n', 'false']:
-            return 0
-        return None
+# On-disk geocoding cache so repeated addresses never hit Nominatim twice
+# (the same file, schema and keys as the CLI scripts' cache)
+@st.cache_resource
+def init_geocode_cache():
+    """Open the SQLite geocoding cache, creating the table if needed"""
+    return open_cache()
+
+geocode_cache = init_geocode_cache()
+
+# The connection is shared by geocoding workers across sessions; serialize access to it
+@st.cache_resource
+def init_geocode_cache_lock():
+    """Create the lock guarding the shared geocoding cache connection"""
+    return threading.Lock()
+
+geocode_cache_lock = init_geocode_cache_lock()
+
+# Reuse one HTTP connection for all Nominatim calls
+@st.cache_resource
+def init_geocode_session():
+    """Create a keep-alive HTTP session for geocoding requests"""
+    session = requests.Session()
+    session.headers.update({'User-Agent': 'AlgaeFoundation-Dashboard/1.0'})
+    # One pooled connection per concurrent geocoding worker
+    pool_size = max(MAPBOX_MAX_WORKERS, NOMINATIM_MAX_WORKERS)
+    session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=pool_size))
+    return session
+
+geocode_session = init_geocode_session()
+
+# Shared across sessions: Nominatim allows max 1 request per second per application
+@st.cache_resource
+def init_geocode_rate_limiter():
+    """Create the rate limiter used for Nominatim requests"""
+    return RateLimiter(min_interval=1.0)
+
+geocode_rate_limiter = init_geocode_rate_limiter()
+
+@st.cache_resource
+def init_mapbox_rate_limiter():
+    """Create the rate limiter used for Mapbox batch requests"""
+    return RateLimiter(min_interval=1.0 / MAPBOX_MAX_QPS)
+
+mapbox_rate_limiter = init_mapbox_rate_limiter()
+
+# Where status messages go: the page itself, or the queue of a background upload
+UPLOAD_REPORTER = contextvars.ContextVar('upload_reporter', default=None)
+
+def notify(kind, *args):
+    """Show a message (st.info/warning/error/success/progress), or hand it to the running upload"""
+    report = UPLOAD_REPORTER.get()
+    if report is not None:
+        report(kind, *args)
+    else:
+        getattr(st, kind)(*args)
 
 # Geocoding function
 def geocode_address(street, city, state, zip_code, country="USA"):
@@ -113,15 +174,8 @@ def geocode_address(street, city, state, zip_code, country="USA"):
     # Remove empty parameters
     params = {k: v for k, v in params.items() if v}
     
-    headers = {
-        'User-Agent': 'AlgaeFoundation-Dashboard/1.0'
-    }
-    
     try:
-        response = requests.get(base_url, params=params, headers=headers, timeout=10)
-        
-        # Respect Nominatim usage policy: max 1 request per second
-        time.sleep(1)
+        response = geocode_session.get(base_url, params=params, timeout=10)
         
         if response.status_code == 200:
             data = response.json()
@@ -133,10 +187,217 @@ def geocode_address(street, city, state, zip_code, country="USA"):
                     result.get('display_name', '')
                 )
     except Exception as e:
-        st.warning(f"Geocoding error for {street}, {city}: {str(e)}")
+        notify('warning', f"Geocoding error for {street}, {city}: {str(e)}")
     
     return (None, None, None)
 
+# Respect Nominatim usage policy: max 1 request per second
+rate_limited_geocode_address = geocode_rate_limiter(geocode_address)
+
+def geocode_batch(addresses):
+    """
+    Geocode up to 50 free-form addresses in one request using the Mapbox batch API
+    Returns list of tuples: (latitude, longitude, formatted_address), one per address
+    """
+    results = [(None, None, None)] * len(addresses)
+    
+    if not MAPBOX_ACCESS_TOKEN:
+        notify('warning', "MAPBOX_ACCESS_TOKEN is not set; falling back to Nominatim")
+        return results
+    
+    # Queries are ';'-separated, so each one is fully URL-encoded
+    query = ';'.join(quote(address, safe='') for address in addresses)
+    url = f"https://api.mapbox.com/geocoding/v5/mapbox.places-permanent/{query}.json"
+    
+    params = {
+        'access_token': MAPBOX_ACCESS_TOKEN,
+        'country': 'us',
+        'limit': 1
+    }
+    
+    try:
+        response = geocode_session.get(url, params=params, timeout=30)
+        
+        if response.status_code == 200:
+            data = response.json()
+            # A single query returns one FeatureCollection instead of a list
+            if isinstance(data, dict):
+                data = [data]
+            for i, collection in enumerate(data[:len(addresses)]):
+                features = (collection or {}).get('features') or []
+                if features:
+                    lon, lat = features[0]['center']
+                    results[i] = (float(lat), float(lon), features[0].get('place_name', ''))
+        else:
+            notify('warning', f"Batch geocoding failed with status {response.status_code}")
+    except Exception as e:
+        notify('warning', f"Batch geocoding error: {str(e)}")
+    
+    return results
+
+rate_limited_geocode_batch = mapbox_rate_limiter(geocode_batch)
+
+def _read_geocode_cache(key):
+    """Return the cached (lat, lon, addr) for a key, or None on a miss"""
+    with geocode_cache_lock:
+        return geocode_cache.execute(
+            "SELECT lat, lon, addr FROM cache WHERE key = ?", (key,)
+        ).fetchone()
+
+def _write_geocode_cache(key, lat, lon, formatted_addr):
+    """Store a successful geocoding result"""
+    with geocode_cache_lock:
+        with geocode_cache:
+            geocode_cache.execute(
+                "INSERT OR REPLACE INTO cache (key, lat, lon, addr) VALUES (?, ?, ?, ?)",
+                (key, lat, lon, formatted_addr)
+            )
+
+def _geocode_cached(key, address):
+    """
+    Resolve an address (street, city, state, zip) whose normalized key is `key`,
+    consulting the on-disk cache before Nominatim. Only successful lookups are
+    written through, so failed ones are retried by the next upload.
+    """
+    row = _read_geocode_cache(key)
+    if row is not None:
+        return row
+    
+    lat, lon, formatted_addr = rate_limited_geocode_address(*address)
+    
+    if lat is not None and lon is not None:
+        _write_geocode_cache(key, lat, lon, formatted_addr)
+    
+    return (lat, lon, formatted_addr)
+
+def _geocode_cached_batch(keys, addresses):
+    """
+    Resolve a list of normalized address keys with the Mapbox batch API;
+    `addresses` maps each key to its (street, city, state, zip) tuple.
+    Cached keys are served from disk; entries the batch call cannot resolve
+    fall back to Nominatim one at a time.
+    """
+    results = {key: _read_geocode_cache(key) for key in keys}
+    misses = [key for key, result in results.items() if result is None]
+    
+    # Blank addresses cannot be sent as a batch query
+    queries = {
+        key: ', '.join(str(part) for part in addresses[key] if pd.notna(part) and str(part).strip())
+        for key in misses
+    }
+    batch_keys = [key for key in misses if queries[key]]
+    
+    if batch_keys:
+        batch_results = rate_limited_geocode_batch([queries[key] for key in batch_keys])
+        for key, (lat, lon, formatted_addr) in zip(batch_keys, batch_results):
+            if lat is not None and lon is not None:
+                _write_geocode_cache(key, lat, lon, formatted_addr)
+                results[key] = (lat, lon, formatted_addr)
+    
+    for key in misses:
+        if results[key] is None:
+            results[key] = _geocode_cached(key, addresses[key])
+    
+    return [results[key] for key in keys]
+
+# Shared geocoding cache in Supabase, so every deployment benefits from past uploads
+REMOTE_CACHE_CHUNK_SIZE = 100  # Hashes per lookup request, keeps the query URL short
+
+def address_hash(key):
+    """SHA1 of a normalized address key, the primary key of the geocode_cache table"""
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()
+
+def fetch_remote_geocodes(keys):
+    """
+    Look up normalized address keys in the Supabase geocode_cache table.
+    Returns dict mapping key to (latitude, longitude, formatted_address) for cache hits.
+    """
+    hashes = {address_hash(key): key for key in keys}
+    hash_list = list(hashes)
+    found = {}
+    
+    try:
+        for i in range(0, len(hash_list), REMOTE_CACHE_CHUNK_SIZE):
+            response = supabase.table('geocode_cache').select('addr_hash,lat,lon,display').in_(
+                'addr_hash', hash_list[i:i + REMOTE_CACHE_CHUNK_SIZE]
+            ).execute()
+            for row in response.data:
+                found[hashes[row['addr_hash']]] = (row['lat'], row['lon'], row['display'])
+    except Exception as e:
+        notify('warning', f"Shared geocode cache unavailable, geocoding without it: {str(e)}")
+    
+    return found
+
+def store_remote_geocodes(results):
+    """Save successful geocoding results (dict of key to tuple) to the Supabase geocode_cache table"""
+    rows = [
+        {'addr_hash': address_hash(key), 'lat': lat, 'lon': lon, 'display': formatted_addr}
+        for key, (lat, lon, formatted_addr) in results.items()
+        if lat is not None and lon is not None
+    ]
+    
+    try:
+        for i in range(0, len(rows), 500):
+            supabase.table('geocode_cache').upsert(rows[i:i + 500]).execute()
+    except Exception as e:
+        notify('warning', f"Could not update shared geocode cache: {str(e)}")
+
+def known_geocodes(df):
+    """Address key -> (lat, lon, formatted address) for already geocoded rows of the loaded data"""
+    if df.empty:
+        return {}
+    geocoded = df[df['Latitude'].notna() & df['Longitude'].notna()]
+    keys = [
+        address_key(*address)
+        for address in geocoded[['School Address', 'City', 'State', 'Zip']].itertuples(index=False, name=None)
+    ]
+    addrs = geocoded['Geocoded Address'].astype(object).where(geocoded['Geocoded Address'].notna(), None)
+    return dict(zip(keys, zip(geocoded['Latitude'].tolist(), geocoded['Longitude'].tolist(), addrs.tolist())))
+
+def _init_geocoding_worker(script_ctx, reporter):
+    """Give a pool thread the caller's Streamlit context and message destination"""
+    add_script_run_ctx(None, script_ctx)
+    UPLOAD_REPORTER.set(reporter)
+
+def geocoding_executor(max_workers):
+    """Thread pool for geocoding whose workers report warnings wherever the caller does"""
+    return ThreadPoolExecutor(
+        max_workers=max_workers,
+        initializer=_init_geocoding_worker,
+        initargs=(get_script_run_ctx(suppress_warning=True), UPLOAD_REPORTER.get())
+    )
+
+# Rows per dashboard insert request. Larger than the scripts' INSERT_BATCH_SIZE:
+# uploaded files are usually small enough to go in one request, and instead of
+# sizing batches from the payload up front, oversized requests are split in half
+# and retried
+UPLOAD_INSERT_BATCH_SIZE = 5000
+
+def insert_records(table, records, batch_size=UPLOAD_INSERT_BATCH_SIZE):
+    """
+    Insert records in batches; the inserted rows are not echoed back.
+    Returns the number of rows inserted.
+    """
+    inserted = 0
+    pending = [records[i:i + batch_size] for i in range(0, len(records), batch_size)]
+    while pending:
+        batch = pending.pop(0)
+        try:
+            # count=exact reports how many rows were written without echoing them
+            response = supabase.table(table).insert(
+                batch,
+                count='exact',
+                returning=ReturnMethod.minimal
+            ).execute()
+            inserted += response.count or 0
+        except Exception as e:
+            if len(batch) > 1 and is_payload_too_large(e):
+                half = len(batch) // 2
+                pending[:0] = [batch[:half], batch[half:]]
+                continue
+            raise
+    return inserted
+
 # Upload and process data function
 def process_uploaded_file(uploaded_file):
     """
@@ -149,10 +410,10 @@ def process_uploaded_file(uploaded_file):
         elif uploaded_file.name.endswith(('.xlsx', '.xls')):
             new_data = pd.read_excel(uploaded_file)
         else:
-            st.error("Unsupported file format. Please upload CSV or Excel file.")
+            notify('error', "Unsupported file format. Please upload CSV or Excel file.")
             return False
         
-        st.info(f"Loaded {len(new_data)} rows from uploaded file")
+        notify('info', f"Loaded {len(new_data)} rows from uploaded file")
         
         # Initialize geocoding columns if they don't exist
         if 'Latitude' not in new_data.columns:
@@ -162,154 +423,770 @@ def process_uploaded_file(uploaded_file):
         if 'Geocoded Address' not in new_data.columns:
             new_data['Geocoded Address'] = None
         
+        # Make sure address columns exist so missing ones geocode as blanks
+        address_columns = ['School Address', 'City', 'State', 'Zip']
+        for col in address_columns:
+            if col not in new_data.columns:
+                new_data[col] = None
+        
         # Geocode addresses
-        st.info("Starting geocoding process...")
-        progress_bar = st.progress(0)
-        status_text = st.empty()
+        notify('info', "Starting geocoding process...")
+        notify('progress', 0.0, "")
         
         total_rows = len(new_data)
-        successful_geocodes = 0
         
-        for idx, row in new_data.iterrows():
-            # Update progress
-            progress = (idx + 1) / total_rows
-            progress_bar.progress(progress)
-            status_text.text(f"Geocoding row {idx + 1} of {total_rows}...")
-            
-            # Get address components
-            street = row.get('School Address', '')
-            city = row.get('City', '')
-            state = row.get('State', '')
-            zip_code = row.get('Zip', '')
-            
-            # Skip if already geocoded
-            if pd.notna(row.get('Latitude')) and pd.notna(row.get('Longitude')):
-                successful_geocodes += 1
-                continue
-            
-            # Geocode
-            lat, lon, formatted_addr = geocode_address(street, city, state, zip_code)
-            
-            if lat is not None and lon is not None:
-                new_data.at[idx, 'Latitude'] = lat
-                new_data.at[idx, 'Longitude'] = lon
-                new_data.at[idx, 'Geocoded Address'] = formatted_addr
-                successful_geocodes += 1
+        # Only rows without coordinates need geocoding
+        needs_geocoding = new_data['Latitude'].isna() | new_data['Longitude'].isna()
+        
+        # Many teachers share a school, so geocode each unique address once
+        address_tuples = list(new_data[address_columns].itertuples(index=False, name=None))
+        address_keys = pd.Series(
+            [address_key(*address) for address in address_tuples],
+            index=new_data.index,
+            dtype=object
+        )
+        # Workers get the original fields; keys are only for lookups
+        addresses = dict(zip(address_keys.tolist(), address_tuples))
+        pending_keys = address_keys[needs_geocoding]
+        
+        # Addresses geocoded by any earlier upload come from the shared cache in one pass
+        pending_unique = pending_keys.drop_duplicates().tolist()
+        lookup = fetch_remote_geocodes(pending_unique)
+        
+        # Then addresses already geocoded in teacher_data, read from the loaded frame
+        missing_keys = [key for key in pending_unique if key not in lookup]
+        if missing_keys:
+            known = known_geocodes(load_data())
+            lookup.update({key: known[key] for key in missing_keys if key in known})
+        unique_keys = [key for key in pending_unique if key not in lookup]
+        total_unique = len(unique_keys)
+        
+        if GEOCODER_BACKEND == "mapbox_batch":
+            # Several batch requests in flight at once, capped by the Mapbox rate limiter
+            batches = [
+                unique_keys[i:i + MAPBOX_BATCH_SIZE]
+                for i in range(0, total_unique, MAPBOX_BATCH_SIZE)
+            ]
+            with geocoding_executor(max_workers=MAPBOX_MAX_WORKERS) as executor:
+                futures = {
+                    executor.submit(_geocode_cached_batch, batch, addresses): batch
+                    for batch in batches
+                }
+                done = 0
+                for future in as_completed(futures):
+                    batch = futures[future]
+                    lookup.update(zip(batch, future.result()))
+                    
+                    # Update progress
+                    done += len(batch)
+                    notify('progress', done / total_unique, f"Geocoded {done} of {total_unique} unique addresses...")
+        else:
+            # Requests start 1 second apart but overlap their round-trips across workers,
+            # while this thread reports progress
+            with geocoding_executor(max_workers=NOMINATIM_MAX_WORKERS) as executor:
+                futures = {executor.submit(_geocode_cached, key, addresses[key]): key for key in unique_keys}
+                for i, future in enumerate(as_completed(futures)):
+                    # Geocode (cached addresses skip the API call)
+                    lookup[futures[future]] = future.result()
+                    
+                    # Progress is queued; the page only shows the latest value on each refresh
+                    notify('progress', (i + 1) / total_unique, f"Geocoded {i + 1} of {total_unique} unique addresses...")
         
-        progress_bar.progress(1.0)
-        status_text.text(f"Geocoding complete! Successfully geocoded {successful_geocodes} of {total_rows} addresses")
+        store_remote_geocodes({key: lookup[key] for key in unique_keys})
+        
+        # Broadcast results back to every row sharing the address in one assignment per column
+        lats, lons, addrs = [], [], []
+        for key in pending_keys.tolist():
+            lat, lon, formatted_addr = lookup[key]
+            lats.append(lat)
+            lons.append(lon)
+            addrs.append(formatted_addr)
+        
+        new_data['Geocoded Address'] = new_data['Geocoded Address'].astype(object)
+        new_data.loc[needs_geocoding, 'Latitude'] = np.array(lats, dtype=float)
+        new_data.loc[needs_geocoding, 'Longitude'] = np.array(lons, dtype=float)
+        new_data.loc[needs_geocoding, 'Geocoded Address'] = addrs
+        
+        successful_geocodes = int(new_data['Latitude'].notna().sum())
+        
+        notify('progress', 1.0, f"Geocoding complete! Successfully geocoded {successful_geocodes} of {total_rows} addresses")
         
         # Prepare records for Supabase
-        st.info("Uploading to database...")
-        records = []
-        for idx, row in new_data.iterrows():
-            record = {
-                'year': str(row['Year']) if pd.notna(row.get('Year')) else None,
-                'first_name': str(row['First Name']) if pd.notna(row.get('First Name')) else None,
-                'last_name': str(row['Last Name']) if pd.notna(row.get('Last Name')) else None,
-                'school_name': str(row['School Name']) if pd.notna(row.get('School Name')) else None,
-                'school_district': str(row['School District']) if pd.notna(row.get('School District')) else None,
-                'school_address': str(row['School Address']) if pd.notna(row.get('School Address')) else None,
-                'city': str(row['City']) if pd.notna(row.get('City')) else None,
-                'state': str(row['State']) if pd.notna(row.get('State')) else None,
-                'zip': str(row['Zip']) if pd.notna(row.get('Zip')) else None,
-                'county': str(row['County']) if pd.notna(row.get('County')) else None,
-                'email': str(row['Email']) if pd.notna(row.get('Email')) else None,
-                'title_1': to_bool(row.get('Title 1')),
-                'public_private': str(row['PublicPrivate']) if pd.notna(row.get('PublicPrivate')) else None,
-                'students_receiving_free_reduced_lunch': to_int(row.get('Students Receiving Free_Reduced Lunch')),
-                'ell_students_in_class': to_bool(row.get('ELL Students in Class')),
-                'returning_teacher': to_bool(row.get('Returning Teacher')),
-                'total_students': to_int(row.get('Total Students')),
-                'semester': str(row['Semester']) if pd.notna(row.get('Semester')) else None,
-                'latitude': float(row['Latitude']) if pd.notna(row.get('Latitude')) else None,
-                'longitude': float(row['Longitude']) if pd.notna(row.get('Longitude')) else None,
-                'geocoded_address': str(row['Geocoded Address']) if pd.notna(row.get('Geocoded Address')) else None,
-            }
-            records.append(record)
+        notify('info', "Uploading to database...")
+        # Coerce whole columns at once, then convert every missing value to None in one pass
+        upload_df = upload_frame(new_data).astype(object)
+        # Uploads add rows: the database numbers each one after the teacher's existing
+        # entries for the term, so an extra class never collides with an earlier upload
+        upload_df['entry'] = None
+        records = upload_df.where(upload_df.notna(), None).to_dict(orient='records')
         
-        # Upload to Supabase in batches
-        batch_size = 100
-        for i in range(0, len(records), batch_size):
-            batch = records[i:i + batch_size]
-            supabase.table('teacher_data').insert(batch).execute()
+        # Upload to Supabase in large batches
+        # The next load pulls the new rows (by updated_at) into the local snapshot
+        inserted = insert_records('teacher_data', records)
+        refresh_state_counts()
         
-        st.success(f"✅ Successfully added {len(new_data)} rows to the database!")
+        notify('success', f"✅ Successfully added {inserted} rows to the database!")
         
         return True
         
     except Exception as e:
-        st.error(f"Error processing file: {str(e)}")
+        notify('error', f"Error processing file: {str(e)}")
         import traceback
-        st.error(traceback.format_exc())
+        notify('error', traceback.format_exc())
         return False
 
+# Uploads run on a background thread; a fragment of the page polls their message queue
+UPLOAD_POLL_INTERVAL = 0.25  # Seconds between progress panel refreshes while an upload runs
+
+def run_upload_job(uploaded_file, messages):
+    """Background thread body: process the file, sending every status message to the queue"""
+    UPLOAD_REPORTER.set(lambda kind, *args: messages.put((kind, *args)))
+    messages.put(('done', process_uploaded_file(uploaded_file)))
+
+def start_upload_job(uploaded_file):
+    """Start processing an upload in the background and return its job state"""
+    messages = queue.Queue()
+    threading.Thread(target=run_upload_job, args=(uploaded_file, messages), daemon=True).start()
+    return {'messages': messages, 'log': [], 'progress': None, 'success': None}
+
+def drain_upload_messages(job):
+    """Fold the messages queued since the last refresh into the job state"""
+    while True:
+        try:
+            kind, *args = job['messages'].get_nowait()
+        except queue.Empty:
+            return
+        if kind == 'done':
+            job['success'] = args[0]
+        elif kind == 'progress':
+            job['progress'] = args
+        else:
+            job['log'].append((kind, *args))
+
+def show_upload_messages(job):
+    """Show everything the background upload has reported so far"""
+    drain_upload_messages(job)
+    for kind, message in job['log']:
+        getattr(st, kind)(message)
+    if job['progress'] is not None:
+        fraction, status = job['progress']
+        st.progress(fraction)
+        st.text(status)
+
+@st.fragment(run_every=UPLOAD_POLL_INTERVAL)
+def upload_progress_panel(job):
+    """Progress of a running upload; only this panel reruns while it polls, not the dashboard"""
+    show_upload_messages(job)
+    if job['success'] is not None:
+        # Finished: rerun the whole page so it shows the outcome and stops polling
+        st.rerun()
+
+# Cleaned copy of teacher_data kept on disk between app restarts, as a Parquet
+# dataset: a full base file plus one appended part file per upload
+DATA_SNAPSHOT_DIR = Path("data_snapshot")
+DATA_SNAPSHOT_BASE = DATA_SNAPSHOT_DIR / "base.parquet"
+
+# teacher_data columns and their names in the original CSV format
+COLUMN_MAPPING = {
+    'first_name': 'First Name',
+    'last_name': 'Last Name',
+    'school_name': 'School Name',
+    'school_district': 'School District',
+    'school_address': 'School Address',
+    'city': 'City',
+    'state': 'State',
+    'zip': 'Zip',
+    'county': 'County',
+    'email': 'Email',
+    'title_1': 'Title 1',
+    'public_private': 'PublicPrivate',
+    'students_receiving_free_reduced_lunch': 'Students Receiving Free_Reduced Lunch',
+    'ell_students_in_class': 'ELL Students in Class',
+    'returning_teacher': 'Returning Teacher',
+    'total_students': 'Total Students',
+    'semester': 'Semester',
+    'year': 'Year',
+    'latitude': 'Latitude',
+    'longitude': 'Longitude',
+    'geocoded_address': 'Geocoded Address'
+}
+
+# Columns the dashboard reads, skipping bookkeeping columns such as created_at
+# (id and updated_at keep the local snapshot in sync)
+TEACHER_DATA_COLUMNS = ','.join(['id', 'updated_at', *COLUMN_MAPPING])
+LOAD_PAGE_SIZE = 1000  # PostgREST returns at most max-rows (1000 by default) per request
+
+def clean_data(df):
+    """Rename database columns to the original CSV format and normalize their dtypes"""
+    # Relabel columns to match original CSV format (in place; the frame is always freshly built)
+    df.columns = [COLUMN_MAPPING.get(col, col) for col in df.columns]
+    
+    if 'updated_at' in df.columns:
+        df['updated_at'] = pd.to_datetime(df['updated_at'], utc=True, format='ISO8601')
+    
+    # Fill null text values (and missing PublicPrivate) with 'Unknown' in one pass
+    text_columns = ['First Name', 'Last Name', 'School Name', 'School District', 
+                   'School Address', 'City', 'State', 'Zip', 'County', 'Email', 'Semester',
+                   'PublicPrivate']
+    text_columns = [col for col in text_columns if col in df.columns]
+    df[text_columns] = df[text_columns].fillna('Unknown')
+    
+    # Normalize flag and count columns with whole-column casts
+    boolean_columns = ['Title 1', 'ELL Students in Class', 'Returning Teacher']
+    for col in boolean_columns:
+        if col in df.columns:
+            df[col] = df[col].astype('boolean')
+    
+    numeric_columns = ['Students Receiving Free_Reduced Lunch', 'Total Students']
+    for col in numeric_columns:
+        if col in df.columns:
+            df[col] = pd.to_numeric(df[col], errors='coerce')
+    
+    return categorize(df)
+
+# Low-cardinality columns kept as categoricals: filters and counts work on integer codes
+CATEGORY_COLUMNS = ['State', 'PublicPrivate', 'Semester', 'County', 'School District', 'Year']
+
+def categorize(df):
+    """Cast the low-cardinality columns to category dtype (categories re-derived from the values)"""
+    for col in CATEGORY_COLUMNS:
+        if col in df.columns:
+            df[col] = df[col].astype(object).astype('category')
+    return df
+
+def fetch_row_count():
+    """Number of rows currently in teacher_data (no row data is transferred)"""
+    response = supabase.table('teacher_data').select('id', count='exact').limit(1).execute()
+    return response.count
+
+def read_data_snapshot():
+    """Return the snapshot DataFrame, or None if there is no readable snapshot"""
+    if not DATA_SNAPSHOT_BASE.exists():
+        return None
+    try:
+        # Part files are read with the base file's schema so all-null columns line up
+        dataset = ds.dataset(
+            DATA_SNAPSHOT_DIR,
+            format='parquet',
+            schema=pq.read_schema(DATA_SNAPSHOT_BASE)
+        )
+        snapshot = dataset.to_table().to_pandas()
+    except Exception:
+        return None
+    return snapshot
+
+def sync_data_snapshot():
+    """
+    Return the snapshot brought up to date with the database, or None if it
+    cannot be: rows inserted or updated since it was written are pulled by
+    updated_at and merged in.
+    """
+    snapshot = read_data_snapshot()
+    if snapshot is None or 'updated_at' not in snapshot.columns:
+        return None
+    last_update = snapshot['updated_at'].max()
+    if pd.isna(last_update):
+        return None
+    
+    # Inserts and in-place updates (the scripts upsert) both move updated_at forward
+    changed_rows = fetch_teacher_data(updated_after=last_update)
+    if changed_rows:
+        changed = clean_data(pd.DataFrame(changed_rows))
+        try:
+            updated = snapshot['id'].isin(changed['id'])
+            if updated.any():
+                # Updated rows replace their old copies, so the snapshot is rewritten
+                merged = pd.concat([snapshot[~updated], changed]).sort_values('id', ignore_index=True)
+                # Both halves are already clean; only their categories need merging
+                write_data_snapshot(categorize(merged))
+            else:
+                append_data_snapshot(changed)
+        except (OSError, pa.ArrowException):
+            return None
+        # Re-read so the categoricals cover the new rows as well
+        snapshot = read_data_snapshot()
+    
+    # Deleted rows never show up as changes, so the row count must still match
+    if snapshot is None or len(snapshot) != fetch_row_count():
+        return None
+    return snapshot
+
+def write_data_snapshot(df):
+    """Replace the snapshot with a full copy of the cleaned data"""
+    shutil.rmtree(DATA_SNAPSHOT_DIR, ignore_errors=True)
+    DATA_SNAPSHOT_DIR.mkdir()
+    df.to_parquet(DATA_SNAPSHOT_BASE, compression='zstd', index=False)
+
+def append_data_snapshot(df):
+    """Add newly inserted (cleaned) rows to the snapshot as a new part file"""
+    if not DATA_SNAPSHOT_BASE.exists():
+        return
+    table = pa.Table.from_pandas(
+        df,
+        schema=pq.read_schema(DATA_SNAPSHOT_BASE),
+        preserve_index=False
+    )
+    pq.write_table(
+        table,
+        DATA_SNAPSHOT_DIR / f"part-{uuid4().hex}.parquet",
+        compression='zstd'
+    )
+
+def fetch_teacher_data(updated_after=None):
+    """Read every teacher_data row (only those changed after the `updated_after` timestamp if given), one page at a time"""
+    rows = []
+    offset = 0
+    while True:
+        query = supabase.table('teacher_data').select(TEACHER_DATA_COLUMNS)
+        if updated_after is not None:
+            query = query.gt('updated_at', updated_after.isoformat())
+        response = (
+            query
+            .order('id')
+            .range(offset, offset + LOAD_PAGE_SIZE - 1)
+            .execute()
+        )
+        rows.extend(response.data)
+        if len(response.data) < LOAD_PAGE_SIZE:
+            return rows
+        offset += LOAD_PAGE_SIZE
+
+def refresh_state_counts():
+    """Recompute the state_teacher_counts view after new rows are inserted"""
+    try:
+        supabase.rpc('refresh_state_teacher_counts').execute()
+    except Exception as e:
+        notify('warning', f"Could not refresh state totals: {str(e)}")
+
+@st.cache_data(show_spinner=False, ttl=3600)
+def load_state_counts(years):
+    """
+    Teachers and students per state for the selected years (all years if empty),
+    from the state_teacher_counts view. Returns None if the view is unavailable.
+    """
+    try:
+        query = supabase.table('state_teacher_counts').select('year,state,teachers,students')
+        if years:
+            query = query.in_('year', list(years))
+        response = query.execute()
+    except Exception:
+        return None
+    
+    counts = pd.DataFrame(response.data, columns=['year', 'state', 'teachers', 'students'])
+    state_counts = counts.groupby('state', as_index=False)[['teachers', 'students']].sum()
+    state_counts.columns = ['State', 'Teacher Count', 'Total Students']
+    return state_counts
+
 # Load and clean data
-@st.cache_data(ttl=60)  # Cache for 60 seconds to allow updates
+@st.cache_resource(ttl=3600)  # Shared read-only frame; uploads from this app clear it immediately
 def load_data():
-    """Load data from Supabase"""
+    """Load data from Supabase, reusing the local Parquet snapshot when it is current"""
     try:
-        # Fetch all data from Supabase
-        response = supabase.table('teacher_data').select('*').execute()
+        # Skip the full download and cleaning when the snapshot can be brought up to date
+        snapshot = sync_data_snapshot()
+        if snapshot is not None:
+            snapshot.attrs['data_version'] = time.time_ns()
+            return snapshot
         
-        # Convert to DataFrame
-        df = pd.DataFrame(response.data)
+        # Fetch all data from Supabase
+        df = pd.DataFrame(fetch_teacher_data())
         
         if df.empty:
-            st.warning("No data found in database")
+            notify('warning', "No data found in database")
             return pd.DataFrame()
         
-        # Rename columns to match original CSV format
-        column_mapping = {
-            'first_name': 'First Name',
-            'last_name': 'Last Name',
-            'school_name': 'School Name',
-            'school_district': 'School District',
-            'school_address': 'School Address',
-            'city': 'City',
-            'state': 'State',
-            'zip': 'Zip',
-            'county': 'County',
-            'email': 'Email',
-            'title_1': 'Title 1',
-            'public_private': 'PublicPrivate',
-            'students_receiving_free_reduced_lunch': 'Students Receiving Free_Reduced Lunch',
-            'ell_students_in_class': 'ELL Students in Class',
-            'returning_teacher': 'Returning Teacher',
-            'total_students': 'Total Students',
-            'semester': 'Semester',
-            'year': 'Year',
-            'latitude': 'Latitude',
-            'longitude': 'Longitude',
-            'geocoded_address': 'Geocoded Address'
-        }
-        
-        df = df.rename(columns=column_mapping)
-        
-        # Fill null text values with 'Unknown'
-        text_columns = ['First Name', 'Last Name', 'School Name', 'School District', 
-                       'School Address', 'City', 'State', 'Zip', 'County', 'Email', 'Semester']
-        for col in text_columns:
-            if col in df.columns:
-                df[col] = df[col].fillna('Unknown')
+        df = clean_data(df)
         
-        # Ensure PublicPrivate has proper values
-        if 'PublicPrivate' in df.columns:
-            df['PublicPrivate'] = df['PublicPrivate'].fillna('Unknown')
+        try:
+            write_data_snapshot(df)
+        except Exception as e:
+            notify('warning', f"Could not save local data snapshot: {str(e)}")
         
+        # Stamp each load so cached helpers can key on it instead of hashing every cell
+        df.attrs['data_version'] = time.time_ns()
         return df
         
     except Exception as e:
-        st.error(f"Error loading data from Supabase: {str(e)}")
+        notify('error', f"Error loading data from Supabase: {str(e)}")
         return pd.DataFrame()
 
+def frame_cache_key(obj):
+    """
+    Cheap cache key for DataFrames/Series derived from load_data(): the load's
+    version stamp plus the row labels, instead of hashing every cell.
+    Anything without a stamp falls back to a full content hash.
+    """
+    version = obj.attrs.get('data_version')
+    if version is None:
+        return pd.util.hash_pandas_object(obj).values.tobytes()
+    columns = tuple(obj.columns) if isinstance(obj, pd.DataFrame) else obj.name
+    return (version, columns, obj.index.values.tobytes())
+
+FRAME_HASH_FUNCS = {pd.DataFrame: frame_cache_key, pd.Series: frame_cache_key}
+
+# Analytics helpers: pure functions of the filtered data
+def state_agg(df):
+    """Teacher count and total students per state"""
+    state_counts = df.groupby('State', observed=True).agg({
+        'First Name': 'count',
+        'Total Students': 'sum'
+    }).reset_index()
+    state_counts.columns = ['State', 'Teacher Count', 'Total Students']
+    return state_counts
+
+def top_n(series, n=10):
+    """
+    Counts of a categorical column's values, most frequent first, limited to
+    `n` (all if `n` is None). Counted with np.bincount over the integer codes.
+    """
+    codes = series.cat.codes.to_numpy()
+    counts = np.bincount(codes[codes >= 0], minlength=len(series.cat.categories))
+    order = np.argsort(-counts, kind='stable')
+    # Categories that were filtered out have a zero count
+    order = order[counts[order] > 0][:n]
+    return pd.Series(counts[order], index=series.cat.categories[order])
+
+def kpi_counts(df):
+    """
+    Student total and True/False counts of the flag columns, from a single .agg pass.
+    Returns dict mapping column name to its counts.
+    """
+    summary = df.agg({
+        'Returning Teacher': ['sum', 'count'],
+        'Title 1': ['sum', 'count'],
+        'ELL Students in Class': ['sum', 'count'],
+        'Total Students': ['sum']
+    })
+    
+    counts = {'Total Students': int(summary.at['sum', 'Total Students'])}
+    for col in ['Returning Teacher', 'Title 1', 'ELL Students in Class']:
+        true_count = int(summary.at['sum', col])
+        counts[col] = (true_count, int(summary.at['count', col]) - true_count)
+    return counts
+
+def label_counts(counts):
+    """Split a counts Series into (labels, counts) arrays for Plotly"""
+    return counts.index.astype(str).to_numpy(), counts.to_numpy()
+
+# Cached as one unit: widget changes that produce the same filtered frame
+# reuse every chart's data, computed together in a single call
+@st.cache_data(show_spinner=False, ttl=3600, hash_funcs=FRAME_HASH_FUNCS)
+def build_chart_payloads(df):
+    """Aggregates for the KPI tiles and every analytics chart, ready to hand to Plotly"""
+    return {
+        'kpis': kpi_counts(df),
+        'state_counts': state_agg(df),
+        'school_type': label_counts(top_n(df['PublicPrivate'], n=None)),
+        'semester': label_counts(top_n(df['Semester'], n=None)),
+        'frl': df['Students Receiving Free_Reduced Lunch'].dropna().to_numpy(),
+        'top_states': label_counts(top_n(df['State'])),
+        'top_counties': label_counts(top_n(df['County'])),
+        'top_districts': label_counts(top_n(df['School District'])),
+    }
+
+@st.cache_data(show_spinner=False, ttl=3600, hash_funcs=FRAME_HASH_FUNCS)
+def to_csv_bytes(df):
+    """Serialize a DataFrame to UTF-8 CSV bytes for the download buttons"""
+    return df.to_csv(index=False).encode('utf-8')
+
+def selection_mask(series, selected):
+    """Rows of a categorical column whose value is among the selected options"""
+    if len(selected) == len(series.cat.categories):
+        # Every option selected (the usual default): only missing values drop out
+        return series.cat.codes.to_numpy() >= 0
+    return series.isin(selected).to_numpy()
+
+# Read-only result shared without a pickle round-trip
+@st.cache_resource(show_spinner=False, max_entries=32, hash_funcs=FRAME_HASH_FUNCS)
+def apply_filters(df, years, states, semesters, school_types, returning_filter, student_range):
+    """
+    Apply the sidebar filters with a single combined boolean mask.
+    Empty selections leave that dimension unfiltered.
+    """
+    # Combine plain NumPy arrays so no index alignment happens between steps
+    mask = np.ones(len(df), dtype=bool)
+    
+    if years:
+        mask &= selection_mask(df['Year'], years)
+    if states:
+        mask &= selection_mask(df['State'], states)
+    if semesters:
+        mask &= selection_mask(df['Semester'], semesters)
+    if school_types:
+        mask &= selection_mask(df['PublicPrivate'], school_types)
+    
+    mask &= df['Total Students'].between(*student_range).to_numpy()
+    
+    # Missing teacher status matches neither option
+    if returning_filter == "Returning Only":
+        mask &= df['Returning Teacher'].eq(True).to_numpy(dtype=bool, na_value=False)
+    elif returning_filter == "New Only":
+        mask &= df['Returning Teacher'].eq(False).to_numpy(dtype=bool, na_value=False)
+    
+    return df.loc[mask]
+
+# Figure builders: cached per filtered frame so reruns with the same filters
+# reuse the finished figures (shared read-only, like apply_filters)
+def state_map_figure(state_counts):
+    """Choropleth of teachers per state from a (State, Teacher Count, Total Students) frame"""
+    # Hover text is formatted by Plotly in the browser from the numeric columns
+    fig_map = go.Figure(data=go.Choropleth(
+        locations=state_counts['State'].to_numpy(),
+        z=state_counts['Teacher Count'].to_numpy(),
+        locationmode='USA-states',
+        colorscale='YlOrRd',
+        customdata=state_counts[['Teacher Count', 'Total Students']].to_numpy(),
+        hovertemplate='%{location}<br>Teachers: %{customdata[0]:,}<br>Students: %{customdata[1]:,}<extra></extra>',
+        colorbar=dict(
+            title=dict(text="Teachers")
+        )
+    ))
+    
+    fig_map.update_layout(
+        title_text='Teacher Distribution Across USA',
+        geo=dict(
+            scope='usa',
+            projection=go.layout.geo.Projection(type='albers usa'),
+            showlakes=True,
+            lakecolor='rgb(255, 255, 255)',
+            bgcolor='rgba(0,0,0,0)'
+        ),
+        height=500,
+        paper_bgcolor='rgba(0,0,0,0)',
+        plot_bgcolor='rgba(0,0,0,0)'
+    )
+    return fig_map
+
+@st.cache_resource(show_spinner=False, max_entries=32, hash_funcs=FRAME_HASH_FUNCS)
+def build_state_map(df):
+    """Choropleth of teachers per state, aggregated from the filtered rows"""
+    return state_map_figure(build_chart_payloads(df)['state_counts'])
+
+DENSITY_GRID_DECIMALS = 2  # Heatmap cell size in degrees of lat/lon (0.01 is roughly 1 km)
+
+@st.cache_resource(show_spinner=False, max_entries=32, hash_funcs=FRAME_HASH_FUNCS)
+def build_location_map(df):
+    """Heatmap and markers for geocoded schools; returns (figure or None, geocoded row count)"""
+    # Filter for rows with valid coordinates
+    geocoded_df = df[df['Latitude'].notna() & df['Longitude'].notna()]
+    if len(geocoded_df) == 0:
+        return None, 0
+    
+    # Create density heatmap from students summed per ~1 km grid cell (rounded lat/lon),
+    # so the heatmap payload grows with the number of cells rather than rows
+    density_df = geocoded_df.groupby(
+        [geocoded_df['Latitude'].round(DENSITY_GRID_DECIMALS),
+         geocoded_df['Longitude'].round(DENSITY_GRID_DECIMALS)]
+    )['Total Students'].sum().reset_index()
+    
+    fig_heatmap = go.Figure(go.Densitymapbox(
+        lat=density_df['Latitude'].to_numpy(),
+        lon=density_df['Longitude'].to_numpy(),
+        z=density_df['Total Students'].to_numpy(),
+        radius=15,
+        colorscale='YlOrRd',
+        showscale=True,
+        hoverinfo='skip',
+        colorbar=dict(title="Students")
+    ))
+    
+    # Add scatter points on top
+    fig_heatmap.add_trace(go.Scattermapbox(
+        lat=geocoded_df['Latitude'].to_numpy(),
+        lon=geocoded_df['Longitude'].to_numpy(),
+        mode='markers',
+        marker=dict(
+            size=6,
+            color='rgb(0, 0, 139)',
+            opacity=0.6
+        ),
+        # Hover text is formatted by Plotly in the browser from the row values
+        customdata=geocoded_df[['School Name', 'City', 'State', 'Total Students']].to_numpy(),
+        hovertemplate='<b>%{customdata[0]}</b><br>%{customdata[1]}, %{customdata[2]}<br>Teachers: 1<br>Students: %{customdata[3]}<extra></extra>',
+        name='Schools'
+    ))
+    
+    # Update layout
+    fig_heatmap.update_layout(
+        mapbox=dict(
+            style='open-street-map',
+            center=dict(lat=39.8283, lon=-98.5795),  # Center of USA
+            zoom=3
+        ),
+        height=600,
+        showlegend=False,
+        margin=dict(l=0, r=0, t=0, b=0)
+    )
+    return fig_heatmap, len(geocoded_df)
+
+@st.cache_resource(show_spinner=False, max_entries=32, hash_funcs=FRAME_HASH_FUNCS)
+def build_analytics_figures(df):
+    """Pie, bar and histogram charts for the Analytics and Top Locations sections"""
+    payloads = build_chart_payloads(df)
+    kpis = payloads['kpis']
+    returning_teachers = kpis['Returning Teacher'][0]
+    new_teachers = len(df) - returning_teachers
+    figures = {}
+    
+    # Returning vs New pie chart
+    fig_returning = go.Figure(data=[go.Pie(
+        labels=['New Teachers', 'Returning Teachers'],
+        values=[new_teachers, returning_teachers],
+        hole=0.4,
+        marker=dict(colors=['#FF6B6B', '#4ECDC4'])
+    )])
+    fig_returning.update_traces(textposition='inside', textinfo='percent+label')
+    fig_returning.update_layout(title_text="Teacher Status Distribution")
+    figures['returning'] = fig_returning
+    
+    # School type distribution
+    school_type_labels, school_type_counts = payloads['school_type']
+    
+    fig_school_type = go.Figure(data=[go.Pie(
+        labels=school_type_labels,
+        values=school_type_counts,
+        hole=0.4,
+        marker=dict(colors=px.colors.sequential.RdBu)
+    )])
+    fig_school_type.update_traces(textposition='inside', textinfo='percent+label')
+    fig_school_type.update_layout(title_text="School Type Distribution")
+    figures['school_type'] = fig_school_type
+    
+    # Title 1 distribution
+    title1_true, title1_false = kpis['Title 1']
+    
+    fig_title1 = go.Figure(data=[go.Bar(
+        x=['Non-Title 1', 'Title 1'],
+        y=[title1_false, title1_true],
+        text=[title1_false, title1_true],
+        textposition='outside',
+        marker=dict(color=['#95E1D3', '#F38181'])
+    )])
+    fig_title1.update_layout(
+        title='Title 1 School Distribution',
+        showlegend=False,
+        xaxis_title='Title 1 Status',
+        yaxis_title='Count'
+    )
+    figures['title1'] = fig_title1
+    
+    # ELL Students
+    ell_true, ell_false = kpis['ELL Students in Class']
+    
+    fig_ell = go.Figure(data=[go.Bar(
+        x=['No ELL Students', 'Has ELL Students'],
+        y=[ell_false, ell_true],
+        text=[ell_false, ell_true],
+        textposition='outside',
+        marker=dict(color=['#FCBAD3', '#AA96DA'])
+    )])
+    fig_ell.update_layout(
+        title='ELL Students in Classrooms',
+        showlegend=False,
+        xaxis_title='ELL Status',
+        yaxis_title='Count'
+    )
+    figures['ell'] = fig_ell
+    
+    # Free/Reduced Lunch histogram
+    frl_data = payloads['frl']
+    
+    fig_frl = go.Figure(data=[go.Histogram(
+        x=frl_data,
+        nbinsx=20,
+        marker=dict(color='#A8E6CF')
+    )])
+    fig_frl.update_layout(
+        title='Distribution of % Free/Reduced Lunch',
+        xaxis_title='% Free/Reduced Lunch',
+        yaxis_title='Count',
+        showlegend=False
+    )
+    figures['frl'] = fig_frl
+    
+    # Teachers by semester
+    semester_labels, semester_counts = payloads['semester']
+    
+    fig_semester = go.Figure(data=[go.Bar(
+        x=semester_labels,
+        y=semester_counts,
+        text=semester_counts,
+        textposition='outside',
+        marker=dict(color=px.colors.sequential.Sunset)
+    )])
+    fig_semester.update_layout(
+        title='Teachers by Semester',
+        showlegend=False,
+        xaxis_title='Semester',
+        yaxis_title='Count'
+    )
+    figures['semester'] = fig_semester
+    
+    # Top locations
+    top_states_labels, top_states_counts = payloads['top_states']
+    
+    fig_top_states = go.Figure(data=[go.Bar(
+        x=top_states_labels,
+        y=top_states_counts,
+        text=top_states_counts,
+        textposition='outside',
+        marker=dict(color=top_states_counts, colorscale='Blues', showscale=False)
+    )])
+    fig_top_states.update_layout(
+        title='Top 10 States',
+        showlegend=False,
+        xaxis_title='State',
+        yaxis_title='Teachers'
+    )
+    figures['top_states'] = fig_top_states
+    
+    top_counties_labels, top_counties_counts = payloads['top_counties']
+    
+    fig_top_counties = go.Figure(data=[go.Bar(
+        y=top_counties_labels,
+        x=top_counties_counts,
+        text=top_counties_counts,
+        textposition='outside',
+        orientation='h',
+        marker=dict(color=top_counties_counts, colorscale='Oranges', showscale=False)
+    )])
+    fig_top_counties.update_layout(
+        title='Top 10 Counties',
+        showlegend=False,
+        xaxis_title='Teachers',
+        yaxis_title='County',
+        yaxis={'categoryorder':'total ascending'}
+    )
+    figures['top_counties'] = fig_top_counties
+    
+    top_districts_labels, top_districts_counts = payloads['top_districts']
+    
+    fig_top_districts = go.Figure(data=[go.Bar(
+        y=top_districts_labels,
+        x=top_districts_counts,
+        text=top_districts_counts,
+        textposition='outside',
+        orientation='h',
+        marker=dict(color=top_districts_counts, colorscale='Greens', showscale=False)
+    )])
+    fig_top_districts.update_layout(
+        title='Top 10 School Districts',
+        showlegend=False,
+        xaxis_title='Teachers',
+        yaxis_title='District',
+        yaxis={'categoryorder':'total ascending'}
+    )
+    figures['top_districts'] = fig_top_districts
+    
+    return figures
+
 df = load_data()
 
-# Sidebar filters
+# Sidebar filters (options come from the categorical columns' categories, no row scan)
 st.sidebar.header("Filters")
 
 # Year filter
-years = sorted(df['Year'].dropna().unique())
+years = sorted(df['Year'].cat.categories)
 selected_years = st.sidebar.multiselect(
     "Select Year(s)",
     options=years,
@@ -317,7 +1194,7 @@ selected_years = st.sidebar.multiselect(
 )
 
 # State filter
-states = sorted(df['State'].dropna().unique())
+states = sorted(df['State'].cat.categories)
 selected_states = st.sidebar.multiselect(
     "Select State(s)",
     options=states,
@@ -325,7 +1202,7 @@ selected_states = st.sidebar.multiselect(
 )
 
 # Semester filter
-semesters = sorted(df['Semester'].dropna().unique())
+semesters = sorted(df['Semester'].cat.categories)
 selected_semesters = st.sidebar.multiselect(
     "Select Semester(s)",
     options=semesters,
@@ -341,7 +1218,7 @@ returning_filter = st.sidebar.radio(
 )
 
 # School type filter
-school_types = sorted(df['PublicPrivate'].dropna().unique())
+school_types = sorted(df['PublicPrivate'].cat.categories)
 selected_school_types = st.sidebar.multiselect(
     "Select School Type(s)",
     options=school_types,
@@ -359,35 +1236,16 @@ student_range = st.sidebar.slider(
     value=(student_min, student_max)
 )
 
-# Apply filters
-filtered_df = df.copy()
-
-# Year filter
-if selected_years:
-    filtered_df = filtered_df[filtered_df['Year'].isin(selected_years)]
-
-# State filter
-if selected_states:
-    filtered_df = filtered_df[filtered_df['State'].isin(selected_states)]
-
-# Semester filter
-if selected_semesters:
-    filtered_df = filtered_df[filtered_df['Semester'].isin(selected_semesters)]
-
-# School type filter
-if selected_school_types:
-    filtered_df = filtered_df[filtered_df['PublicPrivate'].isin(selected_school_types)]
-
-# Numeric filters
-filtered_df = filtered_df[
-    (filtered_df['Total Students'].between(student_range[0], student_range[1]))
-]
-
-# Returning teacher filter
-if returning_filter == "Returning Only":
-    filtered_df = filtered_df[filtered_df['Returning Teacher'] == True]
-elif returning_filter == "New Only":
-    filtered_df = filtered_df[filtered_df['Returning Teacher'] == False]
+# Apply filters (tuples so the cache can hash the selections)
+filtered_df = apply_filters(
+    df,
+    tuple(selected_years),
+    tuple(selected_states),
+    tuple(selected_semesters),
+    tuple(selected_school_types),
+    returning_filter,
+    tuple(student_range)
+)
 
 # Main page
 st.title("🧪 Algae Foundation Analytics Dashboard")
@@ -402,12 +1260,32 @@ with st.expander("📤 Upload New Data", expanded=False):
     if 'processing_complete' not in st.session_state:
         st.session_state.processing_complete = False
     
+    upload_job = st.session_state.get('upload_job')
+    
     # Show success message if just completed
     if st.session_state.processing_complete:
         st.success("✅ Upload completed successfully! Data has been added to the database.")
         if st.button("Upload Another File"):
             st.session_state.processing_complete = False
             st.rerun()
+    elif upload_job is not None and upload_job['success'] is None:
+        upload_progress_panel(upload_job)
+    elif upload_job is not None:
+        show_upload_messages(upload_job)
+        
+        if upload_job['success']:
+            del st.session_state['upload_job']
+            # Mark processing as complete
+            st.session_state.processing_complete = True
+            # Clear cache to reload data (the snapshot picks up only the new rows)
+            st.cache_data.clear()
+            load_data.clear()
+            apply_filters.clear()
+            st.rerun()
+        elif upload_job['success'] is False:
+            if st.button("Try Again"):
+                del st.session_state['upload_job']
+                st.rerun()
     else:
         uploaded_file = st.file_uploader(
             "Choose a file (CSV or Excel)",
@@ -422,14 +1300,8 @@ with st.expander("📤 Upload New Data", expanded=False):
             col1, col2 = st.columns([1, 3])
             with col1:
                 if st.button("🚀 Process and Add Data", type="primary", key="process_button"):
-                    with st.spinner("Processing file..."):
-                        success = process_uploaded_file(uploaded_file)
-                        if success:
-                            # Mark processing as complete
-                            st.session_state.processing_complete = True
-                            # Clear cache to reload data
-                            st.cache_data.clear()
-                            st.rerun()
+                    st.session_state.upload_job = start_upload_job(uploaded_file)
+                    st.rerun()
             with col2:
                 st.info("⚠️ Note: Geocoding may take 1-2 seconds per address due to API rate limits")
 
@@ -437,9 +1309,11 @@ st.markdown("---")
 
 # Calculate key metrics (for use throughout the dashboard)
 total_teachers = len(filtered_df)
-returning_teachers = int(filtered_df['Returning Teacher'].sum())
+payloads = build_chart_payloads(filtered_df)
+kpis = payloads['kpis']
+returning_teachers = kpis['Returning Teacher'][0]
 new_teachers = total_teachers - returning_teachers
-total_students = int(filtered_df['Total Students'].sum())
+total_students = kpis['Total Students']
 
 # KPIs at top
 col1, col2, col3, col4 = st.columns(4)
@@ -461,102 +1335,29 @@ st.markdown("---")
 # Geographic Distribution
 st.subheader("Geographic Distribution")
 
-# State-level choropleth
-state_counts = filtered_df.groupby('State').agg({
-    'First Name': 'count',
-    'Total Students': 'sum'
-}).reset_index()
-state_counts.columns = ['State', 'Teacher Count', 'Total Students']
-
-# Create hover text
-state_counts['text'] = (
-    state_counts['State'] + '<br>' +
-    'Teachers: ' + state_counts['Teacher Count'].astype(str) + '<br>' +
-    'Students: ' + state_counts['Total Students'].astype(str)
-)
-
-fig_map = go.Figure(data=go.Choropleth(
-    locations=state_counts['State'].tolist(),
-    z=state_counts['Teacher Count'].tolist(),
-    locationmode='USA-states',
-    colorscale='YlOrRd',
-    text=state_counts['text'].tolist(),
-    colorbar=dict(
-        title=dict(text="Teachers")
-    )
-))
-
-fig_map.update_layout(
-    title_text='Teacher Distribution Across USA',
-    geo=dict(
-        scope='usa',
-        projection=go.layout.geo.Projection(type='albers usa'),
-        showlakes=True,
-        lakecolor='rgb(255, 255, 255)',
-        bgcolor='rgba(0,0,0,0)'
-    ),
-    height=500,
-    paper_bgcolor='rgba(0,0,0,0)',
-    plot_bgcolor='rgba(0,0,0,0)'
+# State-level choropleth: when only the year filter is narrowed, read the
+# pre-aggregated state_teacher_counts view instead of grouping the rows
+year_filter_only = (
+    len(selected_states) in (0, len(states))
+    and len(selected_semesters) in (0, len(semesters))
+    and len(selected_school_types) in (0, len(school_types))
+    and returning_filter == "All"
+    and tuple(student_range) == (student_min, student_max)
 )
+state_counts = load_state_counts(tuple(selected_years)) if year_filter_only else None
+if state_counts is not None:
+    fig_map = state_map_figure(state_counts)
+else:
+    fig_map = build_state_map(filtered_df)
 st.plotly_chart(fig_map, use_container_width=True)
 
 # Geocoded locations map
 st.subheader("Geocoded School Locations")
 
-# Filter for rows with valid coordinates
-geocoded_df = filtered_df[filtered_df['Latitude'].notna() & filtered_df['Longitude'].notna()].copy()
+fig_heatmap, geocoded_count = build_location_map(filtered_df)
 
-if len(geocoded_df) > 0:
-    st.info(f"Showing {len(geocoded_df)} geocoded locations out of {len(filtered_df)} total schools")
-    
-    # Create hover text
-    geocoded_df['hover_text'] = (
-        '<b>' + geocoded_df['School Name'] + '</b><br>' +
-        geocoded_df['City'] + ', ' + geocoded_df['State'] + '<br>' +
-        'Teachers: 1<br>' +
-        'Students: ' + geocoded_df['Total Students'].astype(str)
-    )
-    
-    # Create density heatmap
-    fig_heatmap = go.Figure(go.Densitymapbox(
-        lat=geocoded_df['Latitude'].tolist(),
-        lon=geocoded_df['Longitude'].tolist(),
-        z=geocoded_df['Total Students'].tolist(),
-        radius=15,
-        colorscale='YlOrRd',
-        showscale=True,
-        hoverinfo='skip',
-        colorbar=dict(title="Students")
-    ))
-    
-    # Add scatter points on top
-    fig_heatmap.add_trace(go.Scattermapbox(
-        lat=geocoded_df['Latitude'].tolist(),
-        lon=geocoded_df['Longitude'].tolist(),
-        mode='markers',
-        marker=dict(
-            size=6,
-            color='rgb(0, 0, 139)',
-            opacity=0.6
-        ),
-        text=geocoded_df['hover_text'].tolist(),
-        hoverinfo='text',
-        name='Schools'
-    ))
-    
-    # Update layout
-    fig_heatmap.update_layout(
-        mapbox=dict(
-            style='open-street-map',
-            center=dict(lat=39.8283, lon=-98.5795),  # Center of USA
-            zoom=3
-        ),
-        height=600,
-        showlegend=False,
-        margin=dict(l=0, r=0, t=0, b=0)
-    )
-    
+if fig_heatmap is not None:
+    st.info(f"Showing {geocoded_count} geocoded locations out of {len(filtered_df)} total schools")
     st.plotly_chart(fig_heatmap, use_container_width=True)
 else:
     st.warning("No geocoded locations available to display on map")
@@ -566,118 +1367,34 @@ st.markdown("---")
 # Analytics section
 st.subheader("Analytics")
 
+figures = build_analytics_figures(filtered_df)
+
 # Row 1: Returning vs New, School Type Distribution
 col1, col2 = st.columns(2)
 
 with col1:
-    # Returning vs New pie chart
-    fig_returning = go.Figure(data=[go.Pie(
-        labels=['New Teachers', 'Returning Teachers'],
-        values=[new_teachers, returning_teachers],
-        hole=0.4,
-        marker=dict(colors=['#FF6B6B', '#4ECDC4'])
-    )])
-    fig_returning.update_traces(textposition='inside', textinfo='percent+label')
-    fig_returning.update_layout(title_text="Teacher Status Distribution")
-    st.plotly_chart(fig_returning, use_container_width=True)
+    st.plotly_chart(figures['returning'], use_container_width=True)
 
 with col2:
-    # School type distribution
-    school_type_counts = filtered_df['PublicPrivate'].value_counts().reset_index()
-    school_type_counts.columns = ['School Type', 'Count']
-    
-    fig_school_type = go.Figure(data=[go.Pie(
-        labels=school_type_counts['School Type'].tolist(),
-        values=school_type_counts['Count'].tolist(),
-        hole=0.4,
-        marker=dict(colors=px.colors.sequential.RdBu)
-    )])
-    fig_school_type.update_traces(textposition='inside', textinfo='percent+label')
-    fig_school_type.update_layout(title_text="School Type Distribution")
-    st.plotly_chart(fig_school_type, use_container_width=True)
+    st.plotly_chart(figures['school_type'], use_container_width=True)
 
 # Row 2: Title 1, ELL Students
 col1, col2 = st.columns(2)
 
 with col1:
-    # Title 1 distribution
-    title1_true = int((filtered_df['Title 1'] == True).sum())
-    title1_false = int((filtered_df['Title 1'] == False).sum())
-    
-    fig_title1 = go.Figure(data=[go.Bar(
-        x=['Non-Title 1', 'Title 1'],
-        y=[title1_false, title1_true],
-        text=[title1_false, title1_true],
-        textposition='outside',
-        marker=dict(color=['#95E1D3', '#F38181'])
-    )])
-    fig_title1.update_layout(
-        title='Title 1 School Distribution',
-        showlegend=False,
-        xaxis_title='Title 1 Status',
-        yaxis_title='Count'
-    )
-    st.plotly_chart(fig_title1, use_container_width=True)
+    st.plotly_chart(figures['title1'], use_container_width=True)
 
 with col2:
-    # ELL Students
-    ell_true = int((filtered_df['ELL Students in Class'] == True).sum())
-    ell_false = int((filtered_df['ELL Students in Class'] == False).sum())
-    
-    fig_ell = go.Figure(data=[go.Bar(
-        x=['No ELL Students', 'Has ELL Students'],
-        y=[ell_false, ell_true],
-        text=[ell_false, ell_true],
-        textposition='outside',
-        marker=dict(color=['#FCBAD3', '#AA96DA'])
-    )])
-    fig_ell.update_layout(
-        title='ELL Students in Classrooms',
-        showlegend=False,
-        xaxis_title='ELL Status',
-        yaxis_title='Count'
-    )
-    st.plotly_chart(fig_ell, use_container_width=True)
+    st.plotly_chart(figures['ell'], use_container_width=True)
 
 # Row 3: Free/Reduced Lunch Distribution, Students by Semester
 col1, col2 = st.columns(2)
 
 with col1:
-    # Free/Reduced Lunch histogram
-    frl_data = filtered_df['Students Receiving Free_Reduced Lunch'].dropna().tolist()
-    
-    fig_frl = go.Figure(data=[go.Histogram(
-        x=frl_data,
-        nbinsx=20,
-        marker=dict(color='#A8E6CF')
-    )])
-    fig_frl.update_layout(
-        title='Distribution of % Free/Reduced Lunch',
-        xaxis_title='% Free/Reduced Lunch',
-        yaxis_title='Count',
-        showlegend=False
-    )
-    st.plotly_chart(fig_frl, use_container_width=True)
+    st.plotly_chart(figures['frl'], use_container_width=True)
 
 with col2:
-    # Teachers by semester
-    semester_counts = filtered_df['Semester'].value_counts().reset_index()
-    semester_counts.columns = ['Semester', 'Count']
-    
-    fig_semester = go.Figure(data=[go.Bar(
-        x=semester_counts['Semester'].tolist(),
-        y=semester_counts['Count'].tolist(),
-        text=semester_counts['Count'].tolist(),
-        textposition='outside',
-        marker=dict(color=px.colors.sequential.Sunset)
-    )])
-    fig_semester.update_layout(
-        title='Teachers by Semester',
-        showlegend=False,
-        xaxis_title='Semester',
-        yaxis_title='Count'
-    )
-    st.plotly_chart(fig_semester, use_container_width=True)
+    st.plotly_chart(figures['semester'], use_container_width=True)
 
 st.markdown("---")
 
@@ -687,76 +1404,32 @@ st.subheader("Top Locations")
 col1, col2, col3 = st.columns(3)
 
 with col1:
-    top_states = filtered_df['State'].value_counts().head(10).reset_index()
-    top_states.columns = ['State', 'Teachers']
-    
-    fig_top_states = go.Figure(data=[go.Bar(
-        x=top_states['State'].tolist(),
-        y=top_states['Teachers'].tolist(),
-        text=top_states['Teachers'].tolist(),
-        textposition='outside',
-        marker=dict(color=top_states['Teachers'].tolist(), colorscale='Blues', showscale=False)
-    )])
-    fig_top_states.update_layout(
-        title='Top 10 States',
-        showlegend=False,
-        xaxis_title='State',
-        yaxis_title='Teachers'
-    )
-    st.plotly_chart(fig_top_states, use_container_width=True)
+    st.plotly_chart(figures['top_states'], use_container_width=True)
 
 with col2:
-    top_counties = filtered_df['County'].value_counts().head(10).reset_index()
-    top_counties.columns = ['County', 'Teachers']
-    
-    fig_top_counties = go.Figure(data=[go.Bar(
-        y=top_counties['County'].tolist(),
-        x=top_counties['Teachers'].tolist(),
-        text=top_counties['Teachers'].tolist(),
-        textposition='outside',
-        orientation='h',
-        marker=dict(color=top_counties['Teachers'].tolist(), colorscale='Oranges', showscale=False)
-    )])
-    fig_top_counties.update_layout(
-        title='Top 10 Counties',
-        showlegend=False,
-        xaxis_title='Teachers',
-        yaxis_title='County',
-        yaxis={'categoryorder':'total ascending'}
-    )
-    st.plotly_chart(fig_top_counties, use_container_width=True)
+    st.plotly_chart(figures['top_counties'], use_container_width=True)
 
 with col3:
-    top_districts = filtered_df['School District'].value_counts().head(10).reset_index()
-    top_districts.columns = ['District', 'Teachers']
-    
-    fig_top_districts = go.Figure(data=[go.Bar(
-        y=top_districts['District'].tolist(),
-        x=top_districts['Teachers'].tolist(),
-        text=top_districts['Teachers'].tolist(),
-        textposition='outside',
-        orientation='h',
-        marker=dict(color=top_districts['Teachers'].tolist(), colorscale='Greens', showscale=False)
-    )])
-    fig_top_districts.update_layout(
-        title='Top 10 School Districts',
-        showlegend=False,
-        xaxis_title='Teachers',
-        yaxis_title='District',
-        yaxis={'categoryorder':'total ascending'}
-    )
-    st.plotly_chart(fig_top_districts, use_container_width=True)
+    st.plotly_chart(figures['top_districts'], use_container_width=True)
 
 st.markdown("---")
 
 # Raw data table
 st.subheader("Raw Data")
 
+# Only one page of rows is sent to the browser; the full data is in the download section
+RAW_DATA_PAGE_SIZE = 1000
+total_pages = max(1, (len(filtered_df) + RAW_DATA_PAGE_SIZE - 1) // RAW_DATA_PAGE_SIZE)
+page = st.number_input("Page", min_value=1, max_value=total_pages, value=1, step=1)
+page_start = (page - 1) * RAW_DATA_PAGE_SIZE
+page_end = min(page_start + RAW_DATA_PAGE_SIZE, len(filtered_df))
+
 st.dataframe(
-    filtered_df,
+    filtered_df.iloc[page_start:page_end],
     use_container_width=True,
     height=400
 )
+st.caption(f"Rows {page_start + 1 if page_end else 0:,}-{page_end:,} of {len(filtered_df):,} (page {page} of {total_pages})")
 
 st.markdown("---")
 
@@ -767,7 +1440,7 @@ col1, col2 = st.columns(2)
 
 with col1:
     # Download filtered data
-    csv_filtered = filtered_df.to_csv(index=False).encode('utf-8')
+    csv_filtered = to_csv_bytes(filtered_df)
     st.download_button(
         label="📥 Download Filtered Data",
         data=csv_filtered,
@@ -778,7 +1451,7 @@ with col1:
 
 with col2:
     # Download all data
-    csv_all = df.to_csv(index=False).encode('utf-8')
+    csv_all = to_csv_bytes(df)
     st.download_button(
         label="📥 Download All Data",
         data=csv_all,
@@ -789,4 +1462,4 @@ with col2:
 
 # Footer
 st.markdown("---")
-st.caption(f"Dashboard generated: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')} | Showing {len(filtered_df):,} of {len(df):,} total records")
\ No newline at end of file
+st.caption(f"Dashboard generated: {pd.Timestamp.now().strftime('%Y-%m-%d %H:%M:%S')} | Showing {len(filtered_df):,} of {len(df):,} total records")
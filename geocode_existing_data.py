@@ -2,59 +2,21 @@
 Script to geocode existing data in the CSV and add Latitude/Longitude columns
 """
 import pandas as pd
-import requests
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from geocoding_utils import (
+    Geocoder, address_keys, load_csv_or_checkpoint,
+    CACHE_PATH, CHECKPOINT_PATH, CHECKPOINT_EVERY, MAX_WORKERS
+)
+import os
 
-def geocode_address(street, city, state, zip_code, country="USA"):
-    """
-    Geocode an address using Nominatim API
-    Returns tuple: (latitude, longitude, formatted_address)
-    """
-    base_url = "https://nominatim.openstreetmap.org/search"
-    
-    params = {
-        'street': str(street) if pd.notna(street) else '',
-        'city': str(city) if pd.notna(city) else '',
-        'state': str(state) if pd.notna(state) else '',
-        'postalcode': str(zip_code) if pd.notna(zip_code) else '',
-        'country': country,
-        'format': 'json',
-        'addressdetails': 1,
-        'limit': 1
-    }
-    
-    # Remove empty parameters
-    params = {k: v for k, v in params.items() if v}
-    
-    headers = {
-        'User-Agent': 'AlgaeFoundation-Dashboard/1.0'
-    }
-    
-    try:
-        response = requests.get(base_url, params=params, headers=headers, timeout=10)
-        
-        # Respect Nominatim usage policy: max 1 request per second
-        time.sleep(1)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                result = data[0]
-                return (
-                    float(result.get('lat', None)),
-                    float(result.get('lon', None)),
-                    result.get('display_name', '')
-                )
-    except Exception as e:
-        print(f"Geocoding error for {street}, {city}: {str(e)}")
-    
-    return (None, None, None)
+# Shared session, rate limiter and address cache (see geocoding_utils.py)
+geocoder = Geocoder()
 
 def main():
     # Load the CSV
     csv_path = "Data for Glenwood Group.csv"
     print(f"Loading {csv_path}...")
-    df = pd.read_csv(csv_path)
+    df = load_csv_or_checkpoint(csv_path)
     
     print(f"Total rows: {len(df)}")
     
@@ -66,61 +28,85 @@ def main():
     if 'Geocoded Address' not in df.columns:
         df['Geocoded Address'] = None
     
-    # Count how many need geocoding
-    needs_geocoding = df[df['Latitude'].isna()].shape[0]
+    # Only rows without coordinates need geocoding
+    address_columns = ['School Address', 'City', 'State', 'Zip']
+    needs_mask = df['Latitude'].isna() | df['Longitude'].isna()
+    needs_geocoding = int(needs_mask.sum())
     print(f"\nRows needing geocoding: {needs_geocoding}")
     
     if needs_geocoding == 0:
         print("All addresses are already geocoded!")
         return
     
+    # Many teachers share a school, so each unique address is geocoded once
+    pending = df.loc[needs_mask, address_columns]
+    keys = address_keys(pending)
+    unique_addresses = pending[~keys.duplicated()]
+    unique_keys = keys[unique_addresses.index]
+    new_addresses = len(unique_keys) - len(geocoder.cached(unique_keys))
+    print(f"Unique addresses: {len(unique_addresses)} ({new_addresses} not in {CACHE_PATH})")
+    
     # Ask for confirmation
-    user_input = input(f"\nThis will make ~{needs_geocoding} API calls at 1 per second (~{needs_geocoding/60:.1f} minutes). Continue? (y/n): ")
+    user_input = input(f"\nAny of these the Census batch geocoder cannot match will use Nominatim at 1 per second (at most ~{new_addresses/60:.1f} minutes). Continue? (y/n): ")
     if user_input.lower() != 'y':
         print("Cancelled.")
         return
     
-    # Geocode addresses
-    successful = 0
-    failed = 0
+    def apply_results():
+        """Copy the geocoded results to every row that shares the address"""
+        cache = geocoder.cached(unique_keys)
+        found = keys[keys.isin(list(cache))]
+        results = pd.DataFrame(
+            [cache[key] for key in found],
+            index=found.index,
+            columns=['Latitude', 'Longitude', 'Geocoded Address']
+        )
+        df.loc[results.index, results.columns] = results
     
-    for idx, row in df.iterrows():
-        # Skip if already geocoded
-        if pd.notna(row.get('Latitude')) and pd.notna(row.get('Longitude')):
-            successful += 1
-            continue
-        
-        print(f"\nProcessing row {idx + 1}/{len(df)}...")
-        
-        # Get address components
-        street = row.get('School Address', '')
-        city = row.get('City', '')
-        state = row.get('State', '')
-        zip_code = row.get('Zip', '')
-        
-        print(f"  Address: {street}, {city}, {state} {zip_code}")
-        
-        # Geocode
-        lat, lon, formatted_addr = geocode_address(street, city, state, zip_code)
-        
-        if lat is not None and lon is not None:
-            df.at[idx, 'Latitude'] = lat
-            df.at[idx, 'Longitude'] = lon
-            df.at[idx, 'Geocoded Address'] = formatted_addr
-            successful += 1
-            print(f"  ✓ Success: {lat}, {lon}")
-        else:
-            failed += 1
-            print(f"  ✗ Failed to geocode")
+    # Most US addresses resolve in a single Census batch request; only the
+    # addresses it cannot match go through the rate-limited Nominatim path
+    uncached = unique_addresses[~unique_keys.isin(list(geocoder.cached(unique_keys)))]
+    if len(uncached):
+        print(f"\nSending {len(uncached)} addresses to the Census batch geocoder...")
+        census_matches = geocoder.geocode_batch_census(uncached.set_axis(keys[uncached.index].to_numpy()))
+        print(f"  ✓ Matched {census_matches}; {len(uncached) - census_matches} fall back to Nominatim")
+    
+    # Geocode remaining addresses
+    addresses = zip(unique_keys, unique_addresses.itertuples(index=False, name=None))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Geocode (cached addresses skip the API call)
+        futures = {
+            executor.submit(geocoder.geocode, *address, key=key): address
+            for key, address in addresses
+        }
         
-        # Save progress every 50 rows
-        if (idx + 1) % 50 == 0:
-            print(f"\n💾 Saving progress...")
-            df.to_csv(csv_path, index=False)
+        for i, future in enumerate(as_completed(futures)):
+            street, city, state, zip_code = futures[future]
+            lat, lon, formatted_addr = future.result()
+            
+            print(f"\nProcessed address {i + 1}/{len(unique_addresses)}...")
+            print(f"  Address: {street}, {city}, {state} {zip_code}")
+            
+            if lat is not None and lon is not None:
+                print(f"  ✓ Success: {lat}, {lon}")
+            else:
+                print(f"  ✗ Failed to geocode")
+            
+            # Results are already in the cache; checkpoint the data every so often
+            if (i + 1) % CHECKPOINT_EVERY == 0:
+                print(f"\n💾 Saving progress...")
+                apply_results()
+                df.to_parquet(CHECKPOINT_PATH, index=False)
     
     # Final save
     print(f"\n💾 Saving final results...")
+    apply_results()
     df.to_csv(csv_path, index=False)
+    if os.path.exists(CHECKPOINT_PATH):
+        os.remove(CHECKPOINT_PATH)
+    
+    successful = int((df['Latitude'].notna() & df['Longitude'].notna()).sum())
+    failed = len(df) - successful
     
     print(f"\n✅ Complete!")
     print(f"   Successful: {successful}")
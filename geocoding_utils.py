@@ -0,0 +1,427 @@
+"""
+Helpers shared by the CLI scripts and the dashboard: geocoding (one HTTP
+session, rate limiter and on-disk address cache behind a single Geocoder)
+and the column coercions and batching used to upload teacher_data
+"""
+import pandas as pd
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import time
+import threading
+from functools import wraps
+import json
+import orjson
+import hashlib
+import os
+import sqlite3
+import io
+
+# Geocoding results kept on disk, so re-runs only look up addresses not seen before.
+# Same file and table as the dashboard's upload cache, so both share their lookups
+CACHE_PATH = "geocode_cache.sqlite"
+
+# JSON cache written by earlier versions of the scripts; imported once, then removed
+LEGACY_CACHE_PATH = ".geocode_cache.json"
+
+# Progress checkpoint for a partly geocoded run; the CSV itself is only rewritten at the end
+CHECKPOINT_PATH = ".geocode_checkpoint.parquet"
+CHECKPOINT_EVERY = 500
+
+# Requests in flight at once; their start times are still spaced by the rate limiter
+MAX_WORKERS = 4
+
+# US Census Bureau batch geocoder: one POST resolves up to 10,000 addresses
+CENSUS_BATCH_URL = "https://geocoding.geo.census.gov/geocoder/locations/addressbatch"
+CENSUS_BATCH_SIZE = 10000
+CENSUS_RESULT_COLUMNS = [
+    'id', 'input_address', 'match', 'match_type',
+    'matched_address', 'coordinates', 'tiger_line_id', 'side'
+]
+
+# Types of the columns geocoding reads, so pandas does not have to infer them
+# (and zip codes keep their leading zeros)
+ADDRESS_DTYPES = {
+    'School Address': 'string',
+    'City': 'string',
+    'State': 'string',
+    'Zip': 'string',
+    'Latitude': 'float64',
+    'Longitude': 'float64',
+    'Geocoded Address': 'string'
+}
+
+def load_csv_or_checkpoint(csv_path):
+    """Load the CSV, or resume from the checkpoint if an interrupted run left a newer one"""
+    if os.path.exists(CHECKPOINT_PATH) and os.path.getmtime(CHECKPOINT_PATH) > os.path.getmtime(csv_path):
+        print(f"Resuming from {CHECKPOINT_PATH}...")
+        return pd.read_parquet(CHECKPOINT_PATH)
+    return pd.read_csv(csv_path, dtype=ADDRESS_DTYPES)
+
+def address_key(street, city, state, zip_code):
+    """Cache key for an address: lower-cased, whitespace collapsed, '|'-joined"""
+    return '|'.join(
+        ' '.join(str(val).lower().split()) if pd.notna(val) else ''
+        for val in (street, city, state, zip_code)
+    )
+
+def address_keys(addresses):
+    """address_key for every row of a street/city/state/zip frame, computed column-wise"""
+    parts = [
+        addresses[col].astype(str).where(addresses[col].notna(), '')
+        .str.lower().str.split().str.join(' ')
+        for col in addresses.columns
+    ]
+    return parts[0].str.cat(parts[1:], sep='|')
+
+def open_cache(cache_path=CACHE_PATH):
+    """
+    Open the SQLite address cache shared by the scripts and the dashboard,
+    creating the table if needed. The connection may be used from several
+    threads, so callers serialize access to it with a lock.
+    """
+    db = sqlite3.connect(cache_path, check_same_thread=False)
+    # WAL lets the dashboard read the cache while a script is writing to it
+    db.execute("PRAGMA journal_mode=WAL")
+    db.execute(
+        "CREATE TABLE IF NOT EXISTS cache (key TEXT PRIMARY KEY, lat REAL, lon REAL, addr TEXT)"
+    )
+    
+    if os.path.exists(LEGACY_CACHE_PATH):
+        with open(LEGACY_CACHE_PATH) as f:
+            legacy = json.load(f)
+        with db:
+            db.executemany(
+                "INSERT OR IGNORE INTO cache (key, lat, lon, addr) VALUES (?, ?, ?, ?)",
+                [(key, *value) for key, value in legacy.items()]
+            )
+        os.remove(LEGACY_CACHE_PATH)
+    
+    return db
+
+class RateLimiter:
+    """
+    Spaces out calls so that at most one starts every `min_interval` seconds.
+    Callers only wait for whatever is left of the interval, so requests from
+    several threads overlap their round-trips while their starts stay spaced.
+    """
+    
+    def __init__(self, min_interval):
+        self.min_interval = min_interval
+        self.next_allowed_ts = 0.0
+        self._lock = threading.Lock()
+    
+    def wait(self):
+        """Block until the next call is allowed to start"""
+        with self._lock:
+            now = time.monotonic()
+            wait = self.next_allowed_ts - now
+            self.next_allowed_ts = max(now, self.next_allowed_ts) + self.min_interval
+        if wait > 0:
+            time.sleep(wait)
+    
+    def __call__(self, func):
+        """Wrap `func` so every call first waits for its slot"""
+        @wraps(func)
+        def rate_limited(*args, **kwargs):
+            self.wait()
+            return func(*args, **kwargs)
+        return rate_limited
+
+class Geocoder:
+    """
+    Nominatim and Census geocoding for the scripts, answering repeated
+    addresses from the cache file they all share
+    """
+    
+    def __init__(self, cache_path=CACHE_PATH, min_interval=1.0, max_workers=MAX_WORKERS):
+        self.cache_path = cache_path
+        self.db = open_cache(cache_path)
+        # One connection is shared by the worker threads; serialize access to it
+        self._db_lock = threading.Lock()
+        
+        # Nominatim usage policy: max 1 request per second
+        self.rate_limiter = RateLimiter(min_interval=min_interval)
+        
+        # Reuse keep-alive connections for all requests
+        self.session = requests.Session()
+        self.session.headers.update({'User-Agent': 'AlgaeFoundation-Dashboard/1.0'})
+        # One pooled connection per worker; retry throttled or failed lookups with backoff
+        self.session.mount('https://', HTTPAdapter(
+            pool_connections=1,
+            pool_maxsize=max_workers,
+            max_retries=Retry(
+                total=3,
+                backoff_factor=1.5,
+                status_forcelist=[429, 500, 502, 503, 504],
+                allowed_methods=["GET"]
+            )
+        ))
+    
+    def lookup(self, key):
+        """Return the cached (lat, lon, addr) for a key, or None on a miss"""
+        with self._db_lock:
+            return self.db.execute(
+                "SELECT lat, lon, addr FROM cache WHERE key = ?", (key,)
+            ).fetchone()
+    
+    def cached(self, keys):
+        """Return {key: (lat, lon, addr)} for the given keys that are in the cache"""
+        keys = list(keys)
+        found = {}
+        with self._db_lock:
+            # Stay under SQLite's limit on query parameters
+            for start in range(0, len(keys), 500):
+                chunk = keys[start:start + 500]
+                rows = self.db.execute(
+                    f"SELECT key, lat, lon, addr FROM cache WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk
+                )
+                found.update((key, (lat, lon, addr)) for key, lat, lon, addr in rows)
+        return found
+    
+    def store(self, results):
+        """Write (key, lat, lon, addr) results to the cache"""
+        with self._db_lock:
+            with self.db:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO cache (key, lat, lon, addr) VALUES (?, ?, ?, ?)",
+                    results
+                )
+    
+    def geocode(self, street, city, state, zip_code, country="USA", key=None):
+        """
+        Geocode an address using Nominatim API, answering repeated addresses from the cache
+        Pass `key` when the address_key is already known to skip normalizing it again
+        Returns tuple: (latitude, longitude, formatted_address)
+        """
+        if key is None:
+            key = address_key(street, city, state, zip_code)
+        row = self.lookup(key)
+        if row is not None:
+            return row
+        
+        base_url = "https://nominatim.openstreetmap.org/search"
+        
+        params = {
+            'street': str(street) if pd.notna(street) else '',
+            'city': str(city) if pd.notna(city) else '',
+            'state': str(state) if pd.notna(state) else '',
+            'postalcode': str(zip_code) if pd.notna(zip_code) else '',
+            'country': country,
+            'format': 'json',
+            'addressdetails': 1,
+            'limit': 1
+        }
+        
+        # Remove empty parameters
+        params = {k: v for k, v in params.items() if v}
+        
+        try:
+            self.rate_limiter.wait()
+            response = self.session.get(base_url, params=params, timeout=10)
+            
+            if response.status_code == 200:
+                data = orjson.loads(response.content)
+                if data and len(data) > 0:
+                    result = data[0]
+                    lat = float(result.get('lat', None))
+                    lon = float(result.get('lon', None))
+                    formatted_addr = result.get('display_name', '')
+                    self.store([(key, lat, lon, formatted_addr)])
+                    return (lat, lon, formatted_addr)
+        except Exception as e:
+            print(f"Geocoding error for {street}, {city}: {str(e)}")
+        
+        return (None, None, None)
+    
+    def geocode_batch_census(self, addresses):
+        """
+        Geocode US addresses in bulk with the Census batch geocoder.
+        `addresses` holds the School Address, City, State and Zip columns and is
+        indexed by cache key. Matches are stored in the cache; addresses the
+        Census geocoder cannot match (No_Match/Tie) are left for Nominatim.
+        Returns the number of addresses matched.
+        """
+        matched = 0
+        for start in range(0, len(addresses), CENSUS_BATCH_SIZE):
+            batch = addresses.iloc[start:start + CENSUS_BATCH_SIZE]
+            
+            # Unique ID, Street address, City, State, ZIP (no header row)
+            rows = batch.fillna('').astype(str)
+            rows['Zip'] = rows['Zip'].str.replace(r'\.0$', '', regex=True)
+            buf = io.StringIO()
+            rows.reset_index(drop=True).to_csv(buf, header=False)
+            
+            try:
+                response = self.session.post(
+                    CENSUS_BATCH_URL,
+                    files={'addressFile': ('addrs.csv', buf.getvalue())},
+                    data={'benchmark': 'Public_AR_Current'},
+                    timeout=600
+                )
+                if response.status_code != 200:
+                    print(f"Census batch geocoding failed with status {response.status_code}")
+                    continue
+                
+                results = pd.read_csv(
+                    io.StringIO(response.text),
+                    header=None,
+                    names=CENSUS_RESULT_COLUMNS,
+                    dtype=str
+                )
+            except Exception as e:
+                print(f"Census batch geocoding error: {str(e)}")
+                continue
+            
+            results = results[results['match'] == 'Match']
+            if results.empty:
+                continue
+            
+            # Coordinates come back as "lon,lat"
+            lon_lat = results['coordinates'].str.split(',', expand=True).astype(float)
+            result_keys = batch.index[results['id'].astype(int)]
+            self.store(zip(result_keys, lon_lat[1], lon_lat[0], results['matched_address']))
+            matched += len(results)
+        
+        return matched
+
+# Batches sent to Supabase at once
+INSERT_MAX_WORKERS = 4
+
+# Rows per insert request, capped so a request body stays well under Supabase's ~6MB limit
+INSERT_BATCH_SIZE = 1000
+MAX_PAYLOAD_BYTES = 4_000_000
+
+# A teacher can submit more than one class per term, so rows sharing these columns
+# are numbered by `entry` (0, 1, ... in file order) to make the key unique
+TEACHER_TERM_COLUMNS = ['year', 'semester', 'first_name', 'last_name', 'school_name']
+
+# Unique key of teacher_data; re-running an upload updates these rows instead of duplicating them
+UPSERT_CONFLICT_COLUMNS = [*TEACHER_TERM_COLUMNS, 'entry']
+
+# Content hashes of the rows in the last successful upload, so re-runs only send changed
+# rows; saved with a fingerprint of the table so they are dropped if it changes elsewhere
+UPLOAD_HASHES_PATH = ".upload_hashes.json"
+
+# teacher_data columns filled from each CSV column, grouped by how they are coerced
+TEXT_FIELDS = {
+    'year': 'Year', 'first_name': 'First Name', 'last_name': 'Last Name',
+    'school_name': 'School Name', 'school_district': 'School District',
+    'school_address': 'School Address', 'city': 'City', 'state': 'State',
+    'zip': 'Zip', 'county': 'County', 'email': 'Email',
+    'public_private': 'PublicPrivate', 'semester': 'Semester',
+    'geocoded_address': 'Geocoded Address'
+}
+BOOL_FIELDS = {
+    'title_1': 'Title 1', 'ell_students_in_class': 'ELL Students in Class',
+    'returning_teacher': 'Returning Teacher'
+}
+INT_FIELDS = {
+    'students_receiving_free_reduced_lunch': 'Students Receiving Free_Reduced Lunch',
+    'total_students': 'Total Students'
+}
+FLOAT_FIELDS = {'latitude': 'Latitude', 'longitude': 'Longitude'}
+
+def to_bool_series(s):
+    """Convert a Series to nullable booleans, handling various input formats."""
+    text = s.astype('string').str.strip().str.lower()
+    return text.isin(['yes', 'y', 'true', '1']).astype('boolean').mask(s.isna())
+
+def to_int_series(s):
+    """Convert a Series to nullable integers, handling various input formats."""
+    numeric = np.trunc(pd.to_numeric(s, errors='coerce'))
+    text = s.astype('string').str.strip().str.lower()
+    # "Yes"/"No" answers in count columns mean all (100) or none (0)
+    fallback = np.where(text.isin(['yes', 'y', 'true']), 100,
+                        np.where(text.isin(['no', 'n', 'false']), 0, np.nan))
+    return numeric.where(numeric.notna(), fallback).astype('Int64')
+
+def upload_frame(df):
+    """
+    teacher_data columns built from a CSV-format frame. Whole columns are
+    coerced at once and missing values stay missing; columns absent from
+    `df` come out all-null. Repeat rows for a teacher and term get
+    increasing `entry` numbers.
+    """
+    def upload_column(name):
+        if name in df.columns:
+            return df[name]
+        return pd.Series(None, index=df.index, dtype=object)
+    
+    upload_df = pd.DataFrame(index=df.index)
+    for field, name in TEXT_FIELDS.items():
+        upload_df[field] = upload_column(name).map(str, na_action='ignore')
+    for field, name in BOOL_FIELDS.items():
+        upload_df[field] = to_bool_series(upload_column(name))
+    for field, name in INT_FIELDS.items():
+        upload_df[field] = to_int_series(upload_column(name))
+    for field, name in FLOAT_FIELDS.items():
+        upload_df[field] = pd.to_numeric(upload_column(name), errors='coerce')
+    upload_df['entry'] = upload_df.groupby(TEACHER_TERM_COLUMNS, dropna=False, sort=False).cumcount()
+    return upload_df
+
+def is_payload_too_large(error):
+    """Check whether an insert was rejected for exceeding the request size limit"""
+    # postgrest-py sets the code to the integer status for non-JSON error bodies (e.g. a gateway 413)
+    return str(getattr(error, 'code', None)) == '413' or 'too large' in str(error).lower()
+
+def payload_batch_size(records, batch_size=INSERT_BATCH_SIZE):
+    """Largest batch size (up to `batch_size`) whose JSON body fits in MAX_PAYLOAD_BYTES"""
+    sample = records[:100]
+    avg_row_bytes = max(1, len(json.dumps(sample, default=str)) // max(1, len(sample)))
+    return min(batch_size, max(50, MAX_PAYLOAD_BYTES // avg_row_bytes))
+
+def record_hash(record):
+    """Short content hash of one upload record"""
+    payload = json.dumps(record, sort_keys=True, default=str).encode()
+    return hashlib.blake2b(payload, digest_size=8).hexdigest()
+
+def table_fingerprint(supabase, table_name):
+    """Row count and latest updated_at of a table; any insert, update or delete changes one of them"""
+    response = (
+        supabase.table(table_name)
+        .select('updated_at', count='exact')
+        .order('updated_at', desc=True)
+        .limit(1)
+        .execute()
+    )
+    latest = response.data[0]['updated_at'] if response.data else None
+    return [response.count, latest]
+
+def load_upload_hashes(fingerprint):
+    """
+    Load the hashes saved by the last successful upload. Empty if there are
+    none, or if the table no longer matches the fingerprint they were saved
+    with (it was emptied, recreated or written to by something else).
+    """
+    if not os.path.exists(UPLOAD_HASHES_PATH):
+        return set()
+    with open(UPLOAD_HASHES_PATH) as f:
+        saved = json.load(f)
+    if not isinstance(saved, dict) or saved.get('fingerprint') != fingerprint:
+        return set()
+    return set(saved['hashes'])
+
+def save_upload_hashes(hashes, fingerprint):
+    """Record which rows the database now holds, along with the table's fingerprint"""
+    with open(UPLOAD_HASHES_PATH, "w") as f:
+        json.dump({'fingerprint': fingerprint, 'hashes': sorted(hashes)}, f)
+
+def upsert_rows(supabase, table_name, rows):
+    """
+    Upsert rows straight through the PostgREST endpoint. The body is encoded
+    with orjson, and return=minimal stops the rows from being echoed back.
+    """
+    response = supabase.postgrest.session.post(
+        # Relative to the session's base URL, which already ends in /rest/v1/
+        table_name,
+        params={'on_conflict': ','.join(UPSERT_CONFLICT_COLUMNS)},
+        content=orjson.dumps(rows),
+        headers={
+            'Content-Type': 'application/json',
+            'Prefer': 'resolution=merge-duplicates,return=minimal'
+        }
+    )
+    response.raise_for_status()
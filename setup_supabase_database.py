@@ -5,8 +5,14 @@ Complete setup script:
 3. Upload all data to Supabase
 """
 import pandas as pd
-import requests
-import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from geocoding_utils import (
+    Geocoder, address_keys, load_csv_or_checkpoint,
+    upload_frame, is_payload_too_large, payload_batch_size, record_hash,
+    table_fingerprint, load_upload_hashes, save_upload_hashes, upsert_rows,
+    CACHE_PATH, CHECKPOINT_PATH, CHECKPOINT_EVERY, MAX_WORKERS,
+    INSERT_MAX_WORKERS
+)
 from supabase import create_client, Client
 from dotenv import load_dotenv
 import os
@@ -17,50 +23,8 @@ load_dotenv()
 SUPABASE_URL = os.getenv("SUPABASE_API_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_ROLE")  # Using service role for admin operations
 
-def geocode_address(street, city, state, zip_code, country="USA"):
-    """
-    Geocode an address using Nominatim API
-    Returns tuple: (latitude, longitude, formatted_address)
-    """
-    base_url = "https://nominatim.openstreetmap.org/search"
-    
-    params = {
-        'street': str(street) if pd.notna(street) else '',
-        'city': str(city) if pd.notna(city) else '',
-        'state': str(state) if pd.notna(state) else '',
-        'postalcode': str(zip_code) if pd.notna(zip_code) else '',
-        'country': country,
-        'format': 'json',
-        'addressdetails': 1,
-        'limit': 1
-    }
-    
-    # Remove empty parameters
-    params = {k: v for k, v in params.items() if v}
-    
-    headers = {
-        'User-Agent': 'AlgaeFoundation-Dashboard/1.0'
-    }
-    
-    try:
-        response = requests.get(base_url, params=params, headers=headers, timeout=10)
-        
-        # Respect Nominatim usage policy: max 1 request per second
-        time.sleep(1)
-        
-        if response.status_code == 200:
-            data = response.json()
-            if data and len(data) > 0:
-                result = data[0]
-                return (
-                    float(result.get('lat', None)),
-                    float(result.get('lon', None)),
-                    result.get('display_name', '')
-                )
-    except Exception as e:
-        print(f"   Geocoding error: {str(e)}")
-    
-    return (None, None, None)
+# Shared session, rate limiter and address cache (see geocoding_utils.py)
+geocoder = Geocoder()
 
 def geocode_csv():
     """Geocode all addresses in the CSV file"""
@@ -70,7 +34,7 @@ def geocode_csv():
     print("=" * 70)
     
     print(f"\nLoading {csv_path}...")
-    df = pd.read_csv(csv_path)
+    df = load_csv_or_checkpoint(csv_path)
     print(f"Total rows: {len(df)}")
     
     # Add geocoding columns if they don't exist
@@ -81,8 +45,10 @@ def geocode_csv():
     if 'Geocoded Address' not in df.columns:
         df['Geocoded Address'] = None
     
-    # Count how many need geocoding
-    needs_geocoding = df[df['Latitude'].isna()].shape[0]
+    # Only rows without coordinates need geocoding
+    address_columns = ['School Address', 'City', 'State', 'Zip']
+    needs_mask = df['Latitude'].isna() | df['Longitude'].isna()
+    needs_geocoding = int(needs_mask.sum())
     already_geocoded = len(df) - needs_geocoding
     
     print(f"\nAlready geocoded: {already_geocoded}")
@@ -92,58 +58,81 @@ def geocode_csv():
         print("\n✅ All addresses are already geocoded!")
         return df
     
-    # Estimate time
-    estimated_minutes = needs_geocoding / 60
-    print(f"\nEstimated time: ~{estimated_minutes:.1f} minutes")
+    # Many teachers share a school, so each unique address is geocoded once
+    pending = df.loc[needs_mask, address_columns]
+    keys = address_keys(pending)
+    unique_addresses = pending[~keys.duplicated()]
+    unique_keys = keys[unique_addresses.index]
+    new_addresses = len(unique_keys) - len(geocoder.cached(unique_keys))
+    print(f"Unique addresses: {len(unique_addresses)} ({new_addresses} not in {CACHE_PATH})")
+    
+    # Worst case: the Census batch geocoder matches nothing and every address goes to Nominatim
+    estimated_minutes = new_addresses / 60
+    print(f"\nEstimated time: at most ~{estimated_minutes:.1f} minutes")
     
     user_input = input(f"\nContinue with geocoding? (y/n): ")
     if user_input.lower() != 'y':
         print("Cancelled.")
         return None
     
-    # Geocode addresses
-    successful = 0
-    failed = 0
-    
+    def apply_results():
+        """Copy the geocoded results to every row that shares the address"""
+        cache = geocoder.cached(unique_keys)
+        found = keys[keys.isin(list(cache))]
+        results = pd.DataFrame(
+            [cache[key] for key in found],
+            index=found.index,
+            columns=['Latitude', 'Longitude', 'Geocoded Address']
+        )
+        df.loc[results.index, results.columns] = results
+    
+    # Most US addresses resolve in a single Census batch request; only the
+    # addresses it cannot match go through the rate-limited Nominatim path
+    uncached = unique_addresses[~unique_keys.isin(list(geocoder.cached(unique_keys)))]
+    if len(uncached):
+        print(f"\nSending {len(uncached)} addresses to the Census batch geocoder...")
+        census_matches = geocoder.geocode_batch_census(uncached.set_axis(keys[uncached.index].to_numpy()))
+        print(f"  ✓ Matched {census_matches}; {len(uncached) - census_matches} fall back to Nominatim")
+    
+    # Geocode remaining addresses
     print("\nStarting geocoding...")
-    for idx, row in df.iterrows():
-        # Skip if already geocoded
-        if pd.notna(row.get('Latitude')) and pd.notna(row.get('Longitude')):
-            successful += 1
-            continue
-        
-        if idx % 10 == 0:  # Progress update every 10 rows
-            print(f"\nProgress: {idx + 1}/{len(df)}")
-        
-        # Get address components
-        street = row.get('School Address', '')
-        city = row.get('City', '')
-        state = row.get('State', '')
-        zip_code = row.get('Zip', '')
-        
-        print(f"  Row {idx + 1}: {city}, {state}")
-        
-        # Geocode
-        lat, lon, formatted_addr = geocode_address(street, city, state, zip_code)
-        
-        if lat is not None and lon is not None:
-            df.at[idx, 'Latitude'] = lat
-            df.at[idx, 'Longitude'] = lon
-            df.at[idx, 'Geocoded Address'] = formatted_addr
-            successful += 1
-            print(f"    ✓ {lat}, {lon}")
-        else:
-            failed += 1
-            print(f"    ✗ Failed")
+    addresses = zip(unique_keys, unique_addresses.itertuples(index=False, name=None))
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+        # Geocode (cached addresses skip the API call)
+        futures = {
+            executor.submit(geocoder.geocode, *address, key=key): address
+            for key, address in addresses
+        }
         
-        # Save progress every 50 rows
-        if (idx + 1) % 50 == 0:
-            print(f"\n💾 Saving progress...")
-            df.to_csv(csv_path, index=False)
+        for i, future in enumerate(as_completed(futures)):
+            street, city, state, zip_code = futures[future]
+            lat, lon, formatted_addr = future.result()
+            
+            if i % 10 == 0:  # Progress update every 10 addresses
+                print(f"\nProgress: {i + 1}/{len(unique_addresses)}")
+            
+            print(f"  Address {i + 1}: {city}, {state}")
+            
+            if lat is not None and lon is not None:
+                print(f"    ✓ {lat}, {lon}")
+            else:
+                print(f"    ✗ Failed")
+            
+            # Results are already in the cache; checkpoint the data every so often
+            if (i + 1) % CHECKPOINT_EVERY == 0:
+                print(f"\n💾 Saving progress...")
+                apply_results()
+                df.to_parquet(CHECKPOINT_PATH, index=False)
     
     # Final save
     print(f"\n💾 Saving final results to {csv_path}...")
+    apply_results()
     df.to_csv(csv_path, index=False)
+    if os.path.exists(CHECKPOINT_PATH):
+        os.remove(CHECKPOINT_PATH)
+    
+    successful = int((df['Latitude'].notna() & df['Longitude'].notna()).sum())
+    failed = len(df) - successful
     
     print(f"\n✅ Geocoding complete!")
     print(f"   Successful: {successful}")
@@ -173,11 +162,8 @@ def setup_supabase_table(df):
     
     # Create SQL for table creation
     create_table_sql = f"""
-    -- Drop table if exists (for fresh start)
-    DROP TABLE IF EXISTS {table_name};
-    
-    -- Create table
-    CREATE TABLE {table_name} (
+    -- Create table (kept across re-runs; uploads upsert into it)
+    CREATE TABLE IF NOT EXISTS {table_name} (
         id BIGSERIAL PRIMARY KEY,
         year TEXT,
         first_name TEXT,
@@ -200,13 +186,91 @@ def setup_supabase_table(df):
         latitude DOUBLE PRECISION,
         longitude DOUBLE PRECISION,
         geocoded_address TEXT,
-        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+        entry INTEGER NOT NULL DEFAULT 0,
+        created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+        updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
     );
     
     -- Create index on state for faster filtering
-    CREATE INDEX idx_state ON {table_name}(state);
-    CREATE INDEX idx_year ON {table_name}(year);
-    CREATE INDEX idx_semester ON {table_name}(semester);
+    CREATE INDEX IF NOT EXISTS idx_state ON {table_name}(state);
+    CREATE INDEX IF NOT EXISTS idx_year ON {table_name}(year);
+    CREATE INDEX IF NOT EXISTS idx_semester ON {table_name}(semester);
+    
+    -- Number repeat rows for a teacher and term in tables created before the entry column
+    ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS entry INTEGER;
+    UPDATE {table_name} t SET entry = n.entry
+    FROM (
+        SELECT id, ROW_NUMBER() OVER (
+            PARTITION BY year, semester, first_name, last_name, school_name ORDER BY id
+        ) - 1 AS entry
+        FROM {table_name}
+    ) n
+    WHERE t.id = n.id AND t.entry IS NULL;
+    ALTER TABLE {table_name} ALTER COLUMN entry SET NOT NULL, ALTER COLUMN entry SET DEFAULT 0;
+    
+    -- Rows inserted with a NULL entry (dashboard uploads) go after the teacher's existing entries
+    CREATE OR REPLACE FUNCTION next_teacher_entry() RETURNS trigger
+    LANGUAGE plpgsql SET search_path = public AS $$
+    BEGIN
+        IF num_nulls(NEW.year, NEW.semester, NEW.first_name, NEW.last_name, NEW.school_name) = 0 THEN
+            SELECT COALESCE(MAX(entry) + 1, 0) INTO NEW.entry FROM {table_name}
+            WHERE year = NEW.year AND semester = NEW.semester AND first_name = NEW.first_name
+                AND last_name = NEW.last_name AND school_name = NEW.school_name;
+        ELSE
+            SELECT COALESCE(MAX(entry) + 1, 0) INTO NEW.entry FROM {table_name}
+            WHERE year IS NOT DISTINCT FROM NEW.year AND semester IS NOT DISTINCT FROM NEW.semester
+                AND first_name IS NOT DISTINCT FROM NEW.first_name
+                AND last_name IS NOT DISTINCT FROM NEW.last_name
+                AND school_name IS NOT DISTINCT FROM NEW.school_name;
+        END IF;
+        RETURN NEW;
+    END;
+    $$;
+    
+    DROP TRIGGER IF EXISTS {table_name}_entry ON {table_name};
+    CREATE TRIGGER {table_name}_entry BEFORE INSERT ON {table_name}
+        FOR EACH ROW WHEN (NEW.entry IS NULL) EXECUTE FUNCTION next_teacher_entry();
+    
+    -- Unique key of a row (the upsert conflict target)
+    DROP INDEX IF EXISTS idx_teacher_term;
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_teacher_entry
+        ON {table_name}(year, semester, first_name, last_name, school_name, entry) NULLS NOT DISTINCT;
+    
+    -- Stamp every change so the dashboard's local snapshot can pull updated rows
+    ALTER TABLE {table_name} ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW();
+    CREATE INDEX IF NOT EXISTS idx_updated_at ON {table_name}(updated_at);
+    
+    CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger
+    LANGUAGE plpgsql SET search_path = public AS $$
+    BEGIN
+        NEW.updated_at := NOW();
+        RETURN NEW;
+    END;
+    $$;
+    
+    DROP TRIGGER IF EXISTS {table_name}_updated_at ON {table_name};
+    CREATE TRIGGER {table_name}_updated_at BEFORE UPDATE ON {table_name}
+        FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+    
+    -- Per-state totals read by the dashboard's map (refreshed after each upload)
+    CREATE MATERIALIZED VIEW IF NOT EXISTS state_teacher_counts AS
+        SELECT year, state, COUNT(*) AS teachers, SUM(total_students) AS students
+        FROM {table_name}
+        WHERE total_students IS NOT NULL
+        GROUP BY year, state;
+    
+    CREATE OR REPLACE FUNCTION refresh_state_teacher_counts() RETURNS void
+    LANGUAGE sql SECURITY DEFINER SET search_path = public AS $$
+        REFRESH MATERIALIZED VIEW state_teacher_counts;
+    $$;
+    
+    -- Shared geocoding cache used by the dashboard's upload page (kept across re-runs)
+    CREATE TABLE IF NOT EXISTS geocode_cache (
+        addr_hash TEXT PRIMARY KEY,
+        lat DOUBLE PRECISION,
+        lon DOUBLE PRECISION,
+        display TEXT
+    );
     """
     
     print("\nSQL Command to execute in Supabase SQL Editor:")
@@ -219,77 +283,65 @@ def setup_supabase_table(df):
     # Prepare data for upload
     print("\nPreparing data for upload...")
     
-    # Helper function to convert to boolean
-    def to_bool(val):
-        if pd.isna(val):
-            return None
-        if isinstance(val, bool):
-            return val
-        val_str = str(val).strip().lower()
-        return val_str in ['yes', 'y', 'true', '1', 'true']
-    
-    # Helper function to convert to int
-    def to_int(val):
-        if pd.isna(val):
-            return None
-        try:
-            # Handle numeric strings
-            return int(float(val))
-        except (ValueError, TypeError):
-            # If it's not a number, try to extract number
-            val_str = str(val).strip()
-            if val_str.lower() in ['yes', 'y', 'true']:
-                return 100  # Assume "Yes" means 100%
-            if val_str.lower() in ['no', 'n', 'false']:
-                return 0
-            return None
-    
-    # Convert DataFrame to records
-    records = []
-    for idx, row in df.iterrows():
-        record = {
-            'year': str(row['Year']) if pd.notna(row['Year']) else None,
-            'first_name': str(row['First Name']) if pd.notna(row['First Name']) else None,
-            'last_name': str(row['Last Name']) if pd.notna(row['Last Name']) else None,
-            'school_name': str(row['School Name']) if pd.notna(row['School Name']) else None,
-            'school_district': str(row['School District']) if pd.notna(row['School District']) else None,
-            'school_address': str(row['School Address']) if pd.notna(row['School Address']) else None,
-            'city': str(row['City']) if pd.notna(row['City']) else None,
-            'state': str(row['State']) if pd.notna(row['State']) else None,
-            'zip': str(row['Zip']) if pd.notna(row['Zip']) else None,
-            'county': str(row['County']) if pd.notna(row['County']) else None,
-            'email': str(row['Email']) if pd.notna(row['Email']) else None,
-            'title_1': to_bool(row['Title 1']),
-            'public_private': str(row['PublicPrivate']) if pd.notna(row['PublicPrivate']) else None,
-            'students_receiving_free_reduced_lunch': to_int(row['Students Receiving Free_Reduced Lunch']),
-            'ell_students_in_class': to_bool(row['ELL Students in Class']),
-            'returning_teacher': to_bool(row['Returning Teacher']),
-            'total_students': to_int(row['Total Students']),
-            'semester': str(row['Semester']) if pd.notna(row['Semester']) else None,
-            'latitude': float(row['Latitude']) if pd.notna(row.get('Latitude')) else None,
-            'longitude': float(row['Longitude']) if pd.notna(row.get('Longitude')) else None,
-            'geocoded_address': str(row['Geocoded Address']) if pd.notna(row.get('Geocoded Address')) else None,
-        }
-        records.append(record)
+    # Coerce whole columns at once, then convert every missing value to None in one pass
+    upload_df = upload_frame(df)
+    
+    # Nothing is dropped: repeat rows for a teacher and term are kept under their own entry number
+    repeated = int((upload_df['entry'] > 0).sum())
+    if repeated:
+        print(f"{repeated} rows repeat a teacher and term from an earlier row; each is kept as a separate entry")
+    
+    records = upload_df.astype(object).where(upload_df.notna(), None).to_dict(orient='records')
     
     print(f"Prepared {len(records)} records for upload")
     
+    # Only rows that changed since the last successful upload are sent again
+    hashes = [record_hash(record) for record in records]
+    previous_hashes = load_upload_hashes(table_fingerprint(supabase, table_name))
+    changed = [record for record, h in zip(records, hashes) if h not in previous_hashes]
+    print(f"{len(records) - len(changed)} unchanged since the last upload, {len(changed)} to upsert")
+    
     # Upload in batches
-    batch_size = 100
-    total_batches = (len(records) + batch_size - 1) // batch_size
+    batch_size = payload_batch_size(changed)
+    total_batches = (len(changed) + batch_size - 1) // batch_size
     
-    print(f"\nUploading data in {total_batches} batches of {batch_size}...")
+    print(f"\nUploading data in {total_batches} batches of {batch_size} ({INSERT_MAX_WORKERS} at a time)...")
     
-    for i in range(0, len(records), batch_size):
-        batch = records[i:i + batch_size]
-        batch_num = i // batch_size + 1
-        
+    def insert_batch(batch):
+        """Upsert one batch, halving it if the request is still too large"""
         try:
-            result = supabase.table(table_name).insert(batch).execute()
-            print(f"  ✓ Batch {batch_num}/{total_batches} uploaded ({len(batch)} records)")
+            upsert_rows(supabase, table_name, batch)
         except Exception as e:
-            print(f"  ✗ Batch {batch_num}/{total_batches} failed: {str(e)}")
-            return False
+            if len(batch) > 1 and is_payload_too_large(e):
+                half = len(batch) // 2
+                insert_batch(batch[:half])
+                insert_batch(batch[half:])
+                return
+            raise
+    
+    batches = [changed[i:i + batch_size] for i in range(0, len(changed), batch_size)]
+    with ThreadPoolExecutor(max_workers=INSERT_MAX_WORKERS) as executor:
+        futures = {executor.submit(insert_batch, batch): batch_num for batch_num, batch in enumerate(batches, 1)}
+        
+        for future in as_completed(futures):
+            batch_num = futures[future]
+            try:
+                future.result()
+                print(f"  ✓ Batch {batch_num}/{total_batches} uploaded ({len(batches[batch_num - 1])} records)")
+            except Exception as e:
+                print(f"  ✗ Batch {batch_num}/{total_batches} failed: {str(e)}")
+                # Stop on the first failure; batches already in flight still finish
+                for pending in futures:
+                    pending.cancel()
+                return False
+    
+    save_upload_hashes(hashes, table_fingerprint(supabase, table_name))
+    
+    # Bring the dashboard's per-state totals up to date
+    try:
+        supabase.rpc('refresh_state_teacher_counts').execute()
+    except Exception as e:
+        print(f"  Note: Could not refresh state_teacher_counts: {str(e)}")
     
     print(f"\n✅ All data uploaded successfully!")
     print(f"   Total records: {len(records)}")
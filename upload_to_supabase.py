@@ -5,15 +5,61 @@ import pandas as pd
 from supabase import create_client, Client
 from dotenv import load_dotenv
 import os
+import io
+import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from geocoding_utils import (
+    upload_frame, is_payload_too_large, payload_batch_size, record_hash,
+    table_fingerprint, load_upload_hashes, save_upload_hashes, upsert_rows,
+    INSERT_MAX_WORKERS, UPSERT_CONFLICT_COLUMNS
+)
 
 # Load environment variables
 load_dotenv()
 
 SUPABASE_URL = os.getenv("SUPABASE_API_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_ROLE")
+# Direct Postgres connection string, only needed for --use-copy
+SUPABASE_DB_URL = os.getenv("SUPABASE_DB_URL")
 
-def upload_to_supabase():
-    """Upload data to Supabase"""
+def copy_to_postgres(upload_df, table_name):
+    """
+    Load all rows in one COPY FROM STDIN over a direct database connection.
+    COPY streams the rows as a single statement instead of parsing and
+    planning an INSERT per PostgREST request. COPY cannot upsert, so the rows
+    go to a staging table and are merged with one INSERT ... ON CONFLICT.
+    """
+    import psycopg2  # Optional dependency, only needed for --use-copy
+    
+    buf = io.StringIO()
+    upload_df.to_csv(buf, index=False, header=False, na_rep='\\N')
+    buf.seek(0)
+    
+    columns = ', '.join(upload_df.columns)
+    updated = [col for col in upload_df.columns if col not in UPSERT_CONFLICT_COLUMNS]
+    new_values = ', '.join(f"EXCLUDED.{col}" for col in updated)
+    old_values = ', '.join(f"{table_name}.{col}" for col in updated)
+    with psycopg2.connect(SUPABASE_DB_URL) as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                f"CREATE TEMP TABLE staging ON COMMIT DROP AS "
+                f"SELECT {columns} FROM {table_name} WITH NO DATA"
+            )
+            cur.copy_expert(
+                f"COPY staging ({columns}) FROM STDIN WITH (FORMAT CSV, NULL '\\N')",
+                buf
+            )
+            # Unchanged rows are left alone, so their updated_at does not move
+            cur.execute(
+                f"INSERT INTO {table_name} ({columns}) SELECT {columns} FROM staging "
+                f"ON CONFLICT ({', '.join(UPSERT_CONFLICT_COLUMNS)}) "
+                f"DO UPDATE SET ({', '.join(updated)}) = ROW({new_values}) "
+                f"WHERE ({old_values}) IS DISTINCT FROM ({new_values})"
+            )
+    conn.close()
+
+def upload_to_supabase(use_copy=False):
+    """Upload data to Supabase (with COPY over SUPABASE_DB_URL when `use_copy` is set)"""
     print("=" * 70)
     print("UPLOADING DATA TO SUPABASE")
     print("=" * 70)
@@ -44,9 +90,7 @@ def upload_to_supabase():
     
     # Create table SQL
     create_table_sql = """
-DROP TABLE IF EXISTS teacher_data;
-
-CREATE TABLE teacher_data (
+CREATE TABLE IF NOT EXISTS teacher_data (
     id BIGSERIAL PRIMARY KEY,
     year TEXT,
     first_name TEXT,
@@ -69,20 +113,87 @@ CREATE TABLE teacher_data (
     latitude DOUBLE PRECISION,
     longitude DOUBLE PRECISION,
     geocoded_address TEXT,
-    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW()
+    entry INTEGER NOT NULL DEFAULT 0,
+    created_at TIMESTAMP WITH TIME ZONE DEFAULT NOW(),
+    updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW()
 );
 
-CREATE INDEX idx_state ON teacher_data(state);
-CREATE INDEX idx_year ON teacher_data(year);
-CREATE INDEX idx_semester ON teacher_data(semester);
+CREATE INDEX IF NOT EXISTS idx_state ON teacher_data(state);
+CREATE INDEX IF NOT EXISTS idx_year ON teacher_data(year);
+CREATE INDEX IF NOT EXISTS idx_semester ON teacher_data(semester);
+
+ALTER TABLE teacher_data ADD COLUMN IF NOT EXISTS entry INTEGER;
+UPDATE teacher_data t SET entry = n.entry
+FROM (
+    SELECT id, ROW_NUMBER() OVER (
+        PARTITION BY year, semester, first_name, last_name, school_name ORDER BY id
+    ) - 1 AS entry
+    FROM teacher_data
+) n
+WHERE t.id = n.id AND t.entry IS NULL;
+ALTER TABLE teacher_data ALTER COLUMN entry SET NOT NULL, ALTER COLUMN entry SET DEFAULT 0;
+
+CREATE OR REPLACE FUNCTION next_teacher_entry() RETURNS trigger
+LANGUAGE plpgsql SET search_path = public AS $$
+BEGIN
+    IF num_nulls(NEW.year, NEW.semester, NEW.first_name, NEW.last_name, NEW.school_name) = 0 THEN
+        SELECT COALESCE(MAX(entry) + 1, 0) INTO NEW.entry FROM teacher_data
+        WHERE year = NEW.year AND semester = NEW.semester AND first_name = NEW.first_name
+            AND last_name = NEW.last_name AND school_name = NEW.school_name;
+    ELSE
+        SELECT COALESCE(MAX(entry) + 1, 0) INTO NEW.entry FROM teacher_data
+        WHERE year IS NOT DISTINCT FROM NEW.year AND semester IS NOT DISTINCT FROM NEW.semester
+            AND first_name IS NOT DISTINCT FROM NEW.first_name
+            AND last_name IS NOT DISTINCT FROM NEW.last_name
+            AND school_name IS NOT DISTINCT FROM NEW.school_name;
+    END IF;
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS teacher_data_entry ON teacher_data;
+CREATE TRIGGER teacher_data_entry BEFORE INSERT ON teacher_data
+    FOR EACH ROW WHEN (NEW.entry IS NULL) EXECUTE FUNCTION next_teacher_entry();
+
+DROP INDEX IF EXISTS idx_teacher_term;
+CREATE UNIQUE INDEX IF NOT EXISTS idx_teacher_entry
+    ON teacher_data(year, semester, first_name, last_name, school_name, entry) NULLS NOT DISTINCT;
+
+ALTER TABLE teacher_data ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT NOW();
+CREATE INDEX IF NOT EXISTS idx_updated_at ON teacher_data(updated_at);
+
+CREATE OR REPLACE FUNCTION touch_updated_at() RETURNS trigger
+LANGUAGE plpgsql SET search_path = public AS $$
+BEGIN
+    NEW.updated_at := NOW();
+    RETURN NEW;
+END;
+$$;
+
+DROP TRIGGER IF EXISTS teacher_data_updated_at ON teacher_data;
+CREATE TRIGGER teacher_data_updated_at BEFORE UPDATE ON teacher_data
+    FOR EACH ROW EXECUTE FUNCTION touch_updated_at();
+
+CREATE MATERIALIZED VIEW IF NOT EXISTS state_teacher_counts AS
+    SELECT year, state, COUNT(*) AS teachers, SUM(total_students) AS students
+    FROM teacher_data
+    WHERE total_students IS NOT NULL
+    GROUP BY year, state;
+
+CREATE OR REPLACE FUNCTION refresh_state_teacher_counts() RETURNS void
+LANGUAGE sql SECURITY DEFINER SET search_path = public AS $$
+    REFRESH MATERIALIZED VIEW state_teacher_counts;
+$$;
     """
     
     try:
         # Execute SQL to create table
-        supabase.postgrest.session.post(
-            f"{SUPABASE_URL}/rest/v1/rpc/exec_sql",
+        response = supabase.postgrest.session.post(
+            "rpc/exec_sql",
             json={"query": create_table_sql}
         )
+        # A missing RPC or a failing statement must fall through to the manual SQL below
+        response.raise_for_status()
         print("✓ Table created successfully!")
     except Exception as e:
         print(f"Note: Could not auto-create table: {str(e)}")
@@ -92,80 +203,83 @@ CREATE INDEX idx_semester ON teacher_data(semester);
         print("-" * 70)
         input("\nPress Enter after running the SQL...")
     
-    # Helper functions
-    def to_bool(val):
-        if pd.isna(val):
-            return None
-        if isinstance(val, bool):
-            return val
-        val_str = str(val).strip().lower()
-        return val_str in ['yes', 'y', 'true', '1', 'true']
-    
-    def to_int(val):
-        if pd.isna(val):
-            return None
-        try:
-            return int(float(val))
-        except (ValueError, TypeError):
-            val_str = str(val).strip()
-            if val_str.lower() in ['yes', 'y', 'true']:
-                return 100
-            if val_str.lower() in ['no', 'n', 'false']:
-                return 0
-            return None
-    
     # Prepare data
     print("\nPreparing data for upload...")
-    records = []
-    
-    for idx, row in df.iterrows():
-        record = {
-            'year': str(row['Year']) if pd.notna(row['Year']) else None,
-            'first_name': str(row['First Name']) if pd.notna(row['First Name']) else None,
-            'last_name': str(row['Last Name']) if pd.notna(row['Last Name']) else None,
-            'school_name': str(row['School Name']) if pd.notna(row['School Name']) else None,
-            'school_district': str(row['School District']) if pd.notna(row['School District']) else None,
-            'school_address': str(row['School Address']) if pd.notna(row['School Address']) else None,
-            'city': str(row['City']) if pd.notna(row['City']) else None,
-            'state': str(row['State']) if pd.notna(row['State']) else None,
-            'zip': str(row['Zip']) if pd.notna(row['Zip']) else None,
-            'county': str(row['County']) if pd.notna(row['County']) else None,
-            'email': str(row['Email']) if pd.notna(row['Email']) else None,
-            'title_1': to_bool(row['Title 1']),
-            'public_private': str(row['PublicPrivate']) if pd.notna(row['PublicPrivate']) else None,
-            'students_receiving_free_reduced_lunch': to_int(row['Students Receiving Free_Reduced Lunch']),
-            'ell_students_in_class': to_bool(row['ELL Students in Class']),
-            'returning_teacher': to_bool(row['Returning Teacher']),
-            'total_students': to_int(row['Total Students']),
-            'semester': str(row['Semester']) if pd.notna(row['Semester']) else None,
-            'latitude': float(row['Latitude']) if pd.notna(row.get('Latitude')) else None,
-            'longitude': float(row['Longitude']) if pd.notna(row.get('Longitude')) else None,
-            'geocoded_address': str(row['Geocoded Address']) if pd.notna(row.get('Geocoded Address')) else None,
-        }
-        records.append(record)
+    # Coerce whole columns at once, then convert every missing value to None in one pass
+    upload_df = upload_frame(df)
     
-    print(f"Prepared {len(records)} records")
+    # Nothing is dropped: repeat rows for a teacher and term are kept under their own entry number
+    repeated = int((upload_df['entry'] > 0).sum())
+    if repeated:
+        print(f"{repeated} rows repeat a teacher and term from an earlier row; each is kept as a separate entry")
     
-    # Upload in batches
-    batch_size = 100
-    total_batches = (len(records) + batch_size - 1) // batch_size
+    records = upload_df.astype(object).where(upload_df.notna(), None).to_dict(orient='records')
     
-    print(f"\nUploading in {total_batches} batches of {batch_size}...")
+    print(f"Prepared {len(records)} records")
+    hashes = [record_hash(record) for record in records]
     
     uploaded = 0
     failed = 0
     
-    for i in range(0, len(records), batch_size):
-        batch = records[i:i + batch_size]
-        batch_num = i // batch_size + 1
+    if use_copy:
+        if SUPABASE_DB_URL is None:
+            print("❌ Error: SUPABASE_DB_URL not found in .env file (required for --use-copy)")
+            return False
         
+        print(f"\nCopying {len(records)} records with COPY...")
         try:
-            result = supabase.table(table_name).insert(batch).execute()
-            uploaded += len(batch)
-            print(f"  ✓ Batch {batch_num}/{total_batches} uploaded ({len(batch)} records)")
+            copy_to_postgres(upload_df, table_name)
+            uploaded = len(records)
         except Exception as e:
-            failed += len(batch)
-            print(f"  ✗ Batch {batch_num}/{total_batches} failed: {str(e)}")
+            failed = len(records)
+            print(f"  ✗ COPY failed: {str(e)}")
+    else:
+        # Only rows that changed since the last successful upload are sent again
+        previous_hashes = load_upload_hashes(table_fingerprint(supabase, table_name))
+        changed = [record for record, h in zip(records, hashes) if h not in previous_hashes]
+        print(f"{len(records) - len(changed)} unchanged since the last upload, {len(changed)} to upsert")
+        
+        # Upload in batches
+        batch_size = payload_batch_size(changed)
+        total_batches = (len(changed) + batch_size - 1) // batch_size
+        
+        print(f"\nUploading in {total_batches} batches of {batch_size} ({INSERT_MAX_WORKERS} at a time)...")
+        
+        def insert_batch(batch):
+            """Upsert one batch, halving it if the request is still too large"""
+            try:
+                upsert_rows(supabase, table_name, batch)
+            except Exception as e:
+                if len(batch) > 1 and is_payload_too_large(e):
+                    half = len(batch) // 2
+                    insert_batch(batch[:half])
+                    insert_batch(batch[half:])
+                    return
+                raise
+        
+        batches = [changed[i:i + batch_size] for i in range(0, len(changed), batch_size)]
+        with ThreadPoolExecutor(max_workers=INSERT_MAX_WORKERS) as executor:
+            futures = {executor.submit(insert_batch, batch): batch_num for batch_num, batch in enumerate(batches, 1)}
+            
+            for future in as_completed(futures):
+                batch_num = futures[future]
+                batch = batches[batch_num - 1]
+                try:
+                    future.result()
+                    uploaded += len(batch)
+                    print(f"  ✓ Batch {batch_num}/{total_batches} uploaded ({len(batch)} records)")
+                except Exception as e:
+                    failed += len(batch)
+                    print(f"  ✗ Batch {batch_num}/{total_batches} failed: {str(e)}")
+    
+    if failed == 0:
+        save_upload_hashes(hashes, table_fingerprint(supabase, table_name))
+    
+    # Bring the dashboard's per-state totals up to date
+    try:
+        supabase.rpc('refresh_state_teacher_counts').execute()
+    except Exception as e:
+        print(f"Note: Could not refresh state_teacher_counts: {str(e)}")
     
     print(f"\n{'='*70}")
     print(f"🎉 UPLOAD COMPLETE!")
@@ -178,4 +292,11 @@ CREATE INDEX idx_semester ON teacher_data(semester);
     return failed == 0
 
 if __name__ == "__main__":
-    upload_to_supabase()
+    parser = argparse.ArgumentParser(description="Upload geocoded data to Supabase")
+    parser.add_argument(
+        "--use-copy",
+        action="store_true",
+        help="Bulk load with Postgres COPY over SUPABASE_DB_URL (requires psycopg2)"
+    )
+    args = parser.parse_args()
+    upload_to_supabase(use_copy=args.use_copy)